@@ -6,6 +6,7 @@
 # Pieter Abbeel (pabbeel@cs.berkeley.edu). http://ai.berkeley.edu.
 
 import util,time
+import pickle
 
 class Agent:
     """
@@ -112,10 +113,13 @@ class ReinforcementAgent(ValueEstimationAgent):
     #    Override These Functions      #
     ####################################
 
-    def update(self, state, action, nextState, reward):
+    def update(self, state, action, nextState, reward, duration=1):
         """
                 This class will call this function, which you write, after
-                observing a transition and reward
+                observing a transition and reward. duration is the number
+                of ticks the transition took (more than one for the macro
+                steps of TFState.macroStep); the bootstrap term is then
+                discounted by gamma ** duration.
         """
         util.raiseNotDefined()
 
@@ -131,8 +135,80 @@ class ReinforcementAgent(ValueEstimationAgent):
         """
         return self.actionFn(state)
 
+    def getAlpha(self, state=None, action=None):
+        """
+          Current learning rate. Uses self.alphaSchedule when one is set,
+          otherwise the constant self.alpha.
+        """
+        if self.alphaSchedule is None:
+            return self.alpha
+        return self.alphaSchedule(self.getScheduleCount(self.alphaSchedule, state, action))
+
+    def getEpsilon(self):
+        """
+          Current exploration rate. Uses self.epsilonSchedule when one is
+          set, otherwise the constant self.epsilon.
+        """
+        if self.epsilonSchedule is None:
+            return self.epsilon
+        return self.epsilonSchedule(self.getScheduleCount(self.epsilonSchedule))
+
+    def getScheduleCount(self, schedule, state=None, action=None):
+        """
+          The counter a schedule is indexed by (see schedules.Schedule).
+        """
+        if schedule.unit == 'episode':
+            return self.episodesSoFar
+        if schedule.unit == 'visit':
+            return self.getVisitCount(state, action)
+        return self.stepsSoFar
+
+    def getVisitCount(self, state, action):
+        """
+          Number of updates of (state, action). Agents that support
+          visit-count schedules override this.
+        """
+        return self.stepsSoFar
+
+    def observeTransition(self, state, action, nextState, deltaReward, duration=1):
+        """
+            Called by environment to inform agent that a transition has
+            been observed. This will result in a call to self.update
+            on the same arguments. stepsSoFar counts ticks, so it grows
+            by the duration of the transition
+        """
+        self.episodeRewards += deltaReward
+        self.update(state, action, nextState, deltaReward, duration)
+        self.stepsSoFar += duration
+
+    def startEpisode(self):
+        """
+          Called by environment when new episode is starting
+        """
+        self.episodeRewards = 0.0
 
-    def __init__(self, actionFn = None, numTraining=100, epsilon=0.5, alpha=0.5, gamma=1):
+    def stopEpisode(self):
+        """
+          Called by environment when episode is done
+        """
+        if self.episodesSoFar < self.numTraining:
+            self.accumTrainRewards += self.episodeRewards
+        else:
+            self.accumTestRewards += self.episodeRewards
+        self.episodesSoFar += 1
+
+    def stopTraining(self):
+        """
+          Turns off learning and exploration, e.g. for a final test episode.
+        """
+        self.alphaSchedule = None
+        self.epsilonSchedule = None
+        self.alpha = 0.0
+        self.epsilon = 0.0
+
+
+    def __init__(self, actionFn = None, numTraining=100, epsilon=0.5, alpha=0.5, gamma=1,
+                 alphaSchedule=None, epsilonSchedule=None):
         """
         actionFn: Function which takes a state and returns the list of legal actions
 
@@ -140,14 +216,42 @@ class ReinforcementAgent(ValueEstimationAgent):
         epsilon  - exploration rate
         gamma    - discount factor
         numTraining - number of training episodes, i.e. no learning after these many episodes
+        alphaSchedule   - optional schedules.Schedule overriding alpha
+        epsilonSchedule - optional schedules.Schedule overriding epsilon
         """
         if actionFn == None:
-            actionFn = lambda state: state.getLegalActions()
+            actionFn = getLegalActionsOf
         self.actionFn = actionFn
         self.episodesSoFar = 0
+        self.stepsSoFar = 0
+        self.episodeRewards = 0.0
         self.accumTrainRewards = 0.0
         self.accumTestRewards = 0.0
         self.numTraining = int(numTraining)
         self.epsilon = float(epsilon)
         self.alpha = float(alpha)
         self.discount = float(gamma)
+        self.alphaSchedule = alphaSchedule
+        self.epsilonSchedule = epsilonSchedule
+
+
+def getLegalActionsOf(state):
+    """
+    Default actionFn. A module-level function (not a lambda) so agents
+    can be pickled.
+    """
+    return state.getLegalActions()
+
+def saveAgent(agent, path):
+    """
+    Pickles a (trained) agent to path.
+    """
+    with open(path, 'wb') as f:
+        pickle.dump(agent, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def loadAgent(path):
+    """
+    Loads an agent written by saveAgent.
+    """
+    with open(path, 'rb') as f:
+        return pickle.load(f)
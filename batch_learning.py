@@ -0,0 +1,127 @@
+"""
+Synchronous tabular Q-learning over a batch of intersections: per tick,
+one NumPy call picks the actions of all of them and one scatter applies
+all their updates.
+"""
+
+import numpy as np
+from states import TFStateEncoder, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH
+from qlearning_agents import EncodedQAgent
+from phase_engine import PhaseEngine, twoPhasePlan
+
+
+class BatchQLearner:
+    """
+    Tabular Q-learning with a dense (numStates, 2) table over
+    TFStateEncoder indices. Actions are indices into states.ACTIONS,
+    as in EncodedQAgent.
+
+    All transitions of an update bootstrap from the table as it was
+    before the call. k transitions hitting the same (state, action) are
+    combined into one step towards their mean target of size
+    1 - (1 - alpha)^k, which is what k sequential updates towards that
+    target would give, so duplicates neither get lost nor overshoot.
+    """
+    def __init__(self, encoder=None, alpha=0.2, epsilon=0.05, gamma=0.8, seed=None):
+        self.encoder = encoder if encoder is not None else TFStateEncoder()
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.discount = gamma
+        self.table = np.zeros((self.encoder.numStates, 2))
+        self.visitCounts = np.zeros((self.encoder.numStates, 2), dtype=np.int64)
+        self.random = np.random.default_rng(seed)
+
+    def legalMask(self, states):
+        """
+        Boolean (N, 2) mask of legal actions, following
+        TFState.getLegalActions on the encoded ticks since the last switch.
+        """
+        since = self.encoder.decode(states)[3]
+        mask = np.empty((len(states), 2), dtype=bool)
+        mask[:, 0] = since >= MIN_TICKS_BEFORE_SWITCH
+        mask[:, 1] = since < MAX_TICKS_BEFORE_SWITCH
+        return mask
+
+    def getActions(self, states, explore=True):
+        """
+        Epsilon-greedy legal actions for an array of encoded states; ties
+        between greedy actions are broken at random.
+        """
+        mask = self.legalMask(states)
+        qValues = np.where(mask, self.table[states], -np.inf)
+        best = qValues == qValues.max(axis=1, keepdims=True)
+        actions = np.argmax(best * self.random.random(best.shape), axis=1)
+        if explore and self.epsilon > 0:
+            explorers = self.random.random(len(states)) < self.epsilon
+            randomActions = np.argmax(mask * self.random.random(mask.shape), axis=1)
+            actions = np.where(explorers, randomActions, actions)
+        return actions
+
+    def computeValues(self, states):
+        """
+        max over legal actions of Q for an array of encoded states.
+        """
+        return np.where(self.legalMask(states), self.table[states], -np.inf).max(axis=1)
+
+    def update(self, states, actions, rewards, nextStates, durations=1):
+        flat = np.asarray(states) * 2 + np.asarray(actions)
+        targets = rewards + self.discount ** np.asarray(durations) * self.computeValues(nextStates)
+        entries, inverse, counts = np.unique(flat, return_inverse=True, return_counts=True)
+        meanTargets = np.bincount(inverse, weights=targets) / counts
+        table = self.table.reshape(-1)
+        table[entries] += (1 - (1 - self.alpha) ** counts) * (meanTargets - table[entries])
+        self.visitCounts.reshape(-1)[entries] += counts
+
+    def getAgent(self, **args):
+        """
+        An EncodedQAgent over the learned table, for TFState episodes,
+        run_simulation tooling or the decision server (checked against
+        the agent's own Q-values by differential.py).
+        """
+        return EncodedQAgent(self.table, self.encoder, self.visitCounts, **args)
+
+
+def encodeEngine(encoder, engine):
+    """
+    TFStateEncoder indices of all intersections of a two-phase PhaseEngine.
+    """
+    plan = engine.plan
+    signal = engine.signal
+    ns_green = (plan.phaseOf[signal] == 0).astype(np.int64)
+    since = np.minimum(plan.elapsedOf[signal], MAX_TICKS_BEFORE_SWITCH)
+    queues = np.minimum(engine.queues, encoder.maxCars)
+    return encoder.encodeValues(ns_green, queues[:, 0], queues[:, 1], since, encoder.timeBin(engine.tick))
+
+
+def runBatch(learner, engine, ticks, learn=True):
+    """
+    Runs all intersections of engine for ticks ticks with the learner's
+    epsilon-greedy policy (greedy if learn is False), learning from every
+    transition. Returns the mean reward per intersection and tick.
+    """
+    if len(engine.plan.phases) != 2:
+        raise ValueError("TFStateEncoder only covers the two-phase plan")
+    total = 0.0
+    states = encodeEngine(learner.encoder, engine)
+    for _ in range(ticks):
+        actions = learner.getActions(states, explore=learn)
+        rewards = engine.step(actions)
+        nextStates = encodeEngine(learner.encoder, engine)
+        if learn:
+            learner.update(states, actions, rewards, nextStates)
+        total += rewards.mean()
+        states = nextStates
+    return total / ticks
+
+
+if __name__ == '__main__':
+    import time
+    learner = BatchQLearner(seed=0)
+    engine = PhaseEngine(twoPhasePlan(), numIntersections=1000, seed=0)
+    for episode in range(5):
+        engine.reset(queues=engine.random.integers(0, 6, size=(1000, 2)))
+        started = time.perf_counter()
+        reward = runBatch(learner, engine, 4320)
+        print(f"Episode {episode + 1}: mean reward per tick {reward:.2f}, {time.perf_counter() - started:.1f}s")
+    engine.reset()
+    print(f"Greedy: mean reward per tick {runBatch(learner, engine, 4320, learn=False):.2f}")
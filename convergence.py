@@ -0,0 +1,166 @@
+"""
+Convergence monitoring and early stopping for training runs, based on
+parameter changes, greedy-policy churn on probe states and the rolling
+mean episode reward.
+"""
+
+import random
+import numpy as np
+import util
+from agents import saveAgent
+from states import TFState
+
+
+def sampleProbeStates(count=200, reward_type='initial', steps=4320, seed=0):
+    """
+    States visited by a uniformly random controller, used to measure
+    greedy-policy churn. Does not disturb the global random state.
+    """
+    saved = random.getstate()
+    random.seed(seed)
+    try:
+        state = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), reward_type)
+        visited = []
+        for _ in range(steps):
+            visited.append(state.copy())
+            state.updateState(random.choice(state.getLegalActions()))
+        return random.sample(visited, min(count, len(visited)))
+    finally:
+        random.setstate(saved)
+
+
+def getParameters(agent):
+    """
+    The learned parameters of an agent as a (tables, entries) NumPy array
+    (both tables of a DoubleQLearningAgent), or None if they are not held
+    in arrays (e.g. a BoundedQTable).
+    """
+    # Encoded agents (EncodedQAgent, DynaQAgent) learn in a dense table
+    # and leave their qValues unused
+    table = getattr(agent, 'table', None)
+    if isinstance(table, np.ndarray):
+        return table.reshape(1, -1)
+    for name in ('weights', 'qValues'):
+        values = getattr(agent, name, None)
+        if isinstance(values, util.SparseVector):
+            tables = [values]
+            other = getattr(agent, name + 'B', None)
+            if isinstance(other, util.SparseVector):
+                tables.append(other)
+            # Tables sharing a vocabulary grow their arrays independently
+            for table in tables:
+                table.reserve(len(table.vocabulary))
+            return np.stack([table.values[:len(values)] for table in tables])
+    return None
+
+
+class ConvergenceMonitor:
+    """
+    Decides when a training run has converged.
+
+    probeStates      - states for policy churn (default: sampleProbeStates())
+    valueTolerance   - max parameter change per episode; falls back to the
+                       change of the probe Q-values when the agent has no
+                       parameter array (None disables the criterion). Only
+                       entries that existed at the previous episode are
+                       compared: tables over full TFStates gain new
+                       entries every episode, which would otherwise count
+                       as changes from 0 forever
+    churnTolerance   - max fraction of probe states changing greedy action
+    rewardTolerance  - max relative change of the rolling mean reward
+    window           - episodes in the rolling reward mean
+    patience         - consecutive episodes all criteria must hold
+    minEpisodes      - never report convergence before this many episodes
+    stopEarly        - whether run_simulation should stop on convergence
+    checkpointPath   - save the agent here on convergence and, with
+                       checkpointEvery, every that many episodes
+    """
+    def __init__(self, probeStates=None, valueTolerance=1e-3, churnTolerance=0.0, rewardTolerance=0.01,
+                 window=5, patience=3, minEpisodes=0, stopEarly=True, checkpointPath=None, checkpointEvery=None,
+                 reward_type='initial'):
+        self.probeStates = probeStates if probeStates is not None else sampleProbeStates(reward_type=reward_type)
+        self.valueTolerance = valueTolerance
+        self.churnTolerance = churnTolerance
+        self.rewardTolerance = rewardTolerance
+        self.window = window
+        self.patience = patience
+        self.minEpisodes = minEpisodes
+        self.stopEarly = stopEarly
+        self.checkpointPath = checkpointPath
+        self.checkpointEvery = checkpointEvery
+        self.parameters = None
+        self.probeQValues = None
+        self.policy = None
+        self.rewards = []
+        self.streak = 0
+        self.converged = False
+        self.convergedAt = None
+        # One entry per episode: dict of the measured deltas
+        self.history = []
+
+    def probe(self, agent):
+        """
+        Q-values and greedy actions on the probe states. Ties go to the
+        first legal action, so unchanged Q-values never count as churn.
+        """
+        qValues = []
+        policy = []
+        for state in self.probeStates:
+            legalActions = state.getLegalActions()
+            values = [agent.getQValue(state, action) for action in legalActions]
+            qValues.extend(values)
+            policy.append(legalActions[int(np.argmax(values))])
+        return np.array(qValues), policy
+
+    def valueDelta(self, agent, probeQValues):
+        parameters = getParameters(agent)
+        if parameters is None:
+            previous, self.probeQValues = self.probeQValues, probeQValues
+            if previous is None:
+                return None
+            return float(np.abs(probeQValues - previous).max(initial=0.0))
+        previous, self.parameters = self.parameters, parameters.copy()
+        if previous is None:
+            return None
+        return float(np.abs(parameters[:, :previous.shape[1]] - previous).max(initial=0.0))
+
+    def rewardDelta(self):
+        if len(self.rewards) < 2 * self.window:
+            return None
+        current = np.mean(self.rewards[-self.window:])
+        previous = np.mean(self.rewards[-2 * self.window:-self.window])
+        return float(abs(current - previous) / max(abs(previous), 1e-9))
+
+    def update(self, agent, episodeReward):
+        """
+        Records one finished training episode. Returns True once the run
+        has converged.
+        """
+        self.rewards.append(episodeReward)
+        probeQValues, policy = self.probe(agent)
+        churn = None
+        if self.policy is not None:
+            churn = sum(a != b for a, b in zip(policy, self.policy)) / max(len(policy), 1)
+        self.policy = policy
+        deltas = {
+            'value': self.valueDelta(agent, probeQValues),
+            'churn': churn,
+            'reward': self.rewardDelta(),
+        }
+        self.history.append(deltas)
+
+        checks = [(deltas['value'], self.valueTolerance),
+                  (deltas['churn'], self.churnTolerance),
+                  (deltas['reward'], self.rewardTolerance)]
+        held = all(tolerance is None or (delta is not None and delta <= tolerance) for delta, tolerance in checks)
+        self.streak = self.streak + 1 if held else 0
+
+        episodes = len(self.rewards)
+        if self.checkpointPath is not None and self.checkpointEvery and episodes % self.checkpointEvery == 0:
+            saveAgent(agent, self.checkpointPath)
+        if not self.converged and self.streak >= self.patience and episodes >= self.minEpisodes:
+            self.converged = True
+            self.convergedAt = episodes
+            if self.checkpointPath is not None:
+                saveAgent(agent, self.checkpointPath)
+        return self.converged
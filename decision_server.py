@@ -0,0 +1,322 @@
+"""
+Local decision service: controllers ask a trained agent for greedy
+actions over TCP or a Unix socket, and the queries of all connections
+are micro-batched into one vectorized evaluation.
+"""
+
+import asyncio
+import json
+import struct
+import time
+import numpy as np
+import util
+from agents import loadAgent
+from states import TFState, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH, ACTIONS
+from qlearning_agents import DoubleQLearningAgent, TrafficApproximateQAgent
+
+# Messages (little endian): b'Q' + REQUEST is answered with REPLY, b'S'
+# with a uint32 length and JSON statistics. Several queries may be in
+# flight on one connection; they are answered in order. A query the
+# server failed to evaluate is answered with action ERROR.
+# intersection id, NS green (0/1), cars NS, cars EW, tick, ticks since last switch
+REQUEST = struct.Struct('<IBHHIH')
+# intersection id, action index into ACTIONS
+REPLY = struct.Struct('<IB')
+LENGTH = struct.Struct('<I')
+ERROR = 0xFF
+
+
+def legalMask(since):
+    """
+    Boolean (N, 2) mask of legal actions (ACTIONS order) from the ticks
+    since the last switch, following TFState.getLegalActions.
+    """
+    mask = np.ones((len(since), len(ACTIONS)), dtype=bool)
+    mask[:, 0] = since >= MIN_TICKS_BEFORE_SWITCH
+    mask[:, 1] = since < MAX_TICKS_BEFORE_SWITCH
+    return mask
+
+
+class BatchPolicy:
+    """
+    Greedy policy of a trained agent evaluated for a batch of requests at
+    once. requests is a list of REQUEST tuples; returns action indices.
+    Ties go to the first action in ACTIONS.
+    """
+    def __init__(self, agent, reward_type='initial', ticks_per_episode=4320):
+        self.agent = agent
+        self.reward_type = reward_type
+        self.ticks_per_episode = ticks_per_episode
+
+    def toState(self, row):
+        ns_green, ns, ew, tick, since = row
+        state = TFState('GREEN' if ns_green else 'RED', 'RED' if ns_green else 'GREEN', ns, ew,
+                        self.reward_type, self.ticks_per_episode)
+        state.tick = tick
+        state.ticks_since_last_switch = since
+        return state
+
+    def evaluate(self, requests):
+        rows = np.array(requests, dtype=np.int64)[:, 1:]
+        if not isinstance(self.agent, TrafficApproximateQAgent) and getattr(self.agent, 'encoder', None) is not None:
+            # Encoded straight from the request fields, without TFStates
+            qValues = self.agent.table[self.encodeValues(rows)]
+            inverse = slice(None)
+        else:
+            # Requests that differ only in the intersection id are evaluated once
+            rows, inverse = np.unique(rows, axis=0, return_inverse=True)
+            states = [self.toState(row) for row in rows.tolist()]
+            qValues = self.computeQValues(states).reshape(len(states), len(ACTIONS))
+            inverse = inverse.reshape(-1)
+        qValues[~legalMask(rows[:, 4])] = -np.inf
+        return np.argmax(qValues, axis=1)[inverse]
+
+    def computeQValues(self, states):
+        """
+        Flat array of Q(state, action) for every state and action in ACTIONS.
+        """
+        if isinstance(self.agent, TrafficApproximateQAgent):
+            indexList = []
+            valueList = []
+            starts = np.zeros(len(states) * len(ACTIONS), dtype=np.int64)
+            position = 0
+            for i, state in enumerate(states):
+                for j, action in enumerate(ACTIONS):
+                    indices, values = self.agent.getFeatureVector(state, action)
+                    starts[i * len(ACTIONS) + j] = position
+                    position += len(indices)
+                    indexList.append(indices)
+                    valueList.append(values)
+            products = self.agent.weights.take(np.concatenate(indexList)) * np.concatenate(valueList)
+            return np.add.reduceat(products, starts)
+        if getattr(self.agent, 'encoder', None) is not None:
+            # Dense table over encoded states (EncodedQAgent, DynaQAgent)
+            return self.agent.table[self.encode(states)].reshape(-1)
+        if isinstance(getattr(self.agent, 'qValues', None), util.SparseVector):
+            # Tabular agent: one vocabulary lookup for the whole batch
+            keys = [(state, action) for state in states for action in ACTIONS]
+            indices = self.agent.qValues.vocabulary.lookupAll(keys)
+            if isinstance(self.agent, DoubleQLearningAgent):
+                return 0.5 * (self.agent.qValues.take(indices) + self.agent.qValuesB.take(indices))
+            return self.agent.qValues.take(indices)
+        # Anything else (e.g. a BoundedQTable) one Q-value at a time
+        return np.array([self.agent.getQValue(state, action) for state in states for action in ACTIONS])
+
+    def encode(self, states):
+        """
+        TFStateEncoder indices of states, encoded as one array operation.
+        """
+        return self.encodeValues(np.array([(state.light_color_ns == 'GREEN', state.num_cars_waiting_ns,
+                                            state.num_cars_waiting_ew, state.tick, state.ticks_since_last_switch)
+                                           for state in states], dtype=np.int64))
+
+    def encodeValues(self, values):
+        """
+        TFStateEncoder indices of (ns_green, ns, ew, tick, since) rows, the
+        REQUEST fields after the intersection id.
+        """
+        encoder = self.agent.encoder
+        return encoder.encodeValues(values[:, 0], np.minimum(values[:, 1], encoder.maxCars),
+                                    np.minimum(values[:, 2], encoder.maxCars),
+                                    np.minimum(values[:, 4], MAX_TICKS_BEFORE_SWITCH), encoder.timeBin(values[:, 3]))
+
+
+class LatencyStats:
+    """
+    Latencies of the last `window` requests and the overall query rate.
+    """
+    def __init__(self, window=100000):
+        self.latencies = np.zeros(window)
+        self.count = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    def record(self, latencies):
+        window = len(self.latencies)
+        positions = (self.count + np.arange(len(latencies))) % window
+        self.latencies[positions] = latencies
+        self.count += len(latencies)
+        self.batches += 1
+
+    def getStats(self):
+        recent = self.latencies[:min(self.count, len(self.latencies))]
+        stats = {
+            'queries': self.count,
+            'batches': self.batches,
+            'queries_per_sec': self.count / max(time.perf_counter() - self.started, 1e-9),
+            'mean_batch_size': self.count / max(self.batches, 1),
+        }
+        for p in (50, 90, 99, 99.9):
+            stats[f'p{p}_ms'] = float(np.percentile(recent, p)) * 1000 if len(recent) else 0.0
+        return stats
+
+
+class DecisionServer:
+    """
+    asyncio server answering decision queries with a BatchPolicy.
+
+    maxBatch - evaluate as soon as this many requests are pending, so
+               at most maxBatch requests are ever pending
+    maxDelay - otherwise evaluate at most this many seconds after the
+               first pending request arrived
+
+    A connection whose client does not read its replies stops being read
+    until the replies are sent (the writer's flow control), so a slow
+    client cannot make the server buffer without bound.
+    """
+    def __init__(self, policy, maxBatch=512, maxDelay=0.0002):
+        self.policy = policy
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.pending = []
+        self.flushHandle = None
+        self.writers = set()
+        self.errors = 0
+        self.stats = LatencyStats()
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                kind = await reader.readexactly(1)
+                if kind == b'Q':
+                    request = REQUEST.unpack(await reader.readexactly(REQUEST.size))
+                    self.submit(request, writer)
+                elif kind == b'S':
+                    payload = json.dumps(self.getStats()).encode()
+                    writer.write(LENGTH.pack(len(payload)) + payload)
+                else:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            self.writers.discard(writer)
+        writer.close()
+
+    def submit(self, request, writer):
+        self.pending.append((request, writer, time.perf_counter()))
+        if len(self.pending) >= self.maxBatch:
+            self.flush()
+        elif self.flushHandle is None:
+            self.flushHandle = asyncio.get_running_loop().call_later(self.maxDelay, self.flush)
+
+    def flush(self):
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            actions = self.policy.evaluate([request for request, _, _ in batch])
+        except Exception:
+            # Every request of the batch still gets a reply, so the
+            # connections stay in step
+            self.errors += len(batch)
+            actions = np.full(len(batch), ERROR)
+        now = time.perf_counter()
+        for (request, writer, _), action in zip(batch, actions.tolist()):
+            if not writer.is_closing():
+                writer.write(REPLY.pack(request[0], action))
+        self.stats.record(np.array([now - arrived for _, _, arrived in batch]))
+
+    def getStats(self):
+        stats = self.stats.getStats()
+        stats['errors'] = self.errors
+        return stats
+
+    async def close(self):
+        """
+        Stops accepting connections, answers the pending requests, flushes
+        the replies and closes every connection.
+        """
+        self.server.close()
+        self.flush()
+        writers = list(self.writers)
+        for writer in writers:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+        await self.server.wait_closed()
+
+
+class DecisionClient:
+    """
+    Client for DecisionServer. decide() pipelines all queries on the
+    connection and returns the actions in request order.
+    """
+    async def connect(self, host='127.0.0.1', port=8765, path=None):
+        if path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def decide(self, requests):
+        """
+        requests: list of (id, ns_green, ns, ew, tick, since) tuples. The
+        server answers the queries of a connection in order, so replies are
+        matched to requests by position (ids may repeat). Raises
+        RuntimeError, after reading every reply, if the server failed to
+        evaluate any of them.
+        """
+        self.writer.write(b''.join(b'Q' + REQUEST.pack(*request) for request in requests))
+        await self.writer.drain()
+        actions = []
+        for request in requests:
+            intersection, action = REPLY.unpack(await self.reader.readexactly(REPLY.size))
+            if intersection != request[0]:
+                raise ConnectionError(f"Reply for intersection {intersection}, expected {request[0]}")
+            actions.append(None if action == ERROR else ACTIONS[action])
+        if None in actions:
+            raise RuntimeError(f"Server failed to evaluate {actions.count(None)} of {len(requests)} queries")
+        return actions
+
+    async def getStats(self):
+        self.writer.write(b'S')
+        await self.writer.drain()
+        length, = LENGTH.unpack(await self.reader.readexactly(LENGTH.size))
+        return json.loads(await self.reader.readexactly(length))
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def serve(agentPath, host='127.0.0.1', port=8765, path=None, maxBatch=512, maxDelay=0.0002,
+                reward_type='initial', ticks_per_episode=4320, statsInterval=10.0):
+    policy = BatchPolicy(loadAgent(agentPath), reward_type, ticks_per_episode)
+    server = DecisionServer(policy, maxBatch, maxDelay)
+    await server.start(host, port, path)
+    print(f"Serving {agentPath} on {path or f'{host}:{port}'}")
+    try:
+        while True:
+            await asyncio.sleep(statsInterval)
+            print(server.getStats())
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve greedy decisions of a trained agent (see agents.saveAgent).')
+    parser.add_argument('agent', help='pickled QLearningAgent or TrafficApproximateQAgent')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', default=None, help='serve on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=512)
+    parser.add_argument('--max-delay-ms', type=float, default=0.2)
+    parser.add_argument('--reward-type', default='initial')
+    parser.add_argument('--ticks-per-episode', type=int, default=4320)
+    args = parser.parse_args()
+    asyncio.run(serve(args.agent, args.host, args.port, args.unix, args.max_batch, args.max_delay_ms / 1000.0,
+                      args.reward_type, args.ticks_per_episode))
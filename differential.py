@@ -0,0 +1,535 @@
+"""
+Differential tests of the alternative engines and learners against the
+reference TFState / QLearningAgent semantics, reporting minimized traces
+on divergence. `python differential.py` runs every check in the tree.
+"""
+
+import itertools
+import math
+import os
+import random
+import shutil
+import tempfile
+from collections import deque
+import numpy as np
+from states import TFState, TFStateEncoder, ACTIONS
+from qlearning_agents import QLearningAgent, DoubleQLearningAgent, EncodedQAgent
+from qtable import BoundedQTable
+from phase_engine import PhaseEngine, twoPhasePlan
+from batch_learning import BatchQLearner
+from decision_server import BatchPolicy
+from convergence import getParameters
+
+REWARD_TYPES = ('initial', 'squared', 'balanced', 'penalty')
+
+
+def seededArrivals(seed, ticks, ticks_per_episode=4320):
+    """
+    Arrivals of ticks 1..ticks drawn by TFState.sampleArrivals with
+    random.seed(seed), without disturbing the global random state.
+    """
+    saved = random.getstate()
+    random.seed(seed)
+    try:
+        state = TFState('RED', 'GREEN', 0, 0, ticks_per_episode=ticks_per_episode)
+        arrivals = []
+        for tick in range(1, ticks + 1):
+            state.tick = tick
+            arrivals.append(state.sampleArrivals())
+        return arrivals
+    finally:
+        random.setstate(saved)
+
+
+class ReferenceEnv:
+    """
+    TFState with injected arrivals. step takes an action and the arrivals
+    of one or more ticks: after the action, forced actions are applied
+    while only one action is legal, stopping at the next decision or once
+    the arrivals are used up (the macroStep rule). It returns the
+    observation after the stretch: (ns, ew, total reward, legal actions,
+    ticks, waits).
+
+    waits comes from a plain FIFO model of the vehicles (arrivals queue up
+    before departures leave): per direction the number of served cars,
+    their mean and maximum wait, the cars waiting and the longest wait so
+    far. Alternatives that do not track vehicles report None.
+    """
+    maxTicks = 1
+
+    def __init__(self, reward_type='initial'):
+        self.reward_type = reward_type
+
+    def reset(self, start):
+        self.state = start.copy()
+        self.state.reward_type = self.reward_type
+        self.waiting = {}
+        self.served = {}
+        for direction, cars in (('ns', start.num_cars_waiting_ns), ('ew', start.num_cars_waiting_ew)):
+            self.waiting[direction] = deque([[start.tick, cars]] if cars else [])
+            # count, total wait, longest wait
+            self.served[direction] = [0, 0, 0]
+
+    def snapshot(self):
+        snapshot = self.state.copy()
+        snapshot.__dict__.pop('sampleArrivals', None)
+        return snapshot
+
+    def step(self, action, arrivals):
+        state = self.state
+        reward = 0
+        for ticks, count in enumerate(arrivals, 1):
+            ns, ew = state.num_cars_waiting_ns, state.num_cars_waiting_ew
+            state.sampleArrivals = lambda: count
+            state.updateState(action)
+            reward += state.getReward()
+            ns_arrivals = 3 * count // 5
+            self.track('ns', state.tick, ns_arrivals, ns + ns_arrivals - state.num_cars_waiting_ns)
+            self.track('ew', state.tick, count - ns_arrivals, ew + count - ns_arrivals - state.num_cars_waiting_ew)
+            legal = state.getLegalActions()
+            if len(legal) != 1:
+                break
+            action = legal[0]
+        return self.observe(reward, ticks, self.getWaits())
+
+    def track(self, direction, tick, arrivals, departures):
+        waiting = self.waiting[direction]
+        served = self.served[direction]
+        if arrivals:
+            waiting.append([tick, arrivals])
+        while departures:
+            cars = min(departures, waiting[0][1])
+            wait = tick - waiting[0][0]
+            served[0] += cars
+            served[1] += cars * wait
+            served[2] = max(served[2], wait)
+            waiting[0][1] -= cars
+            departures -= cars
+            if not waiting[0][1]:
+                waiting.popleft()
+
+    def getWaits(self):
+        waits = []
+        for direction in ('ns', 'ew'):
+            count, total, longest = self.served[direction]
+            waiting = self.waiting[direction]
+            waits += [count, total / count if count else 0.0, longest, sum(cars for _, cars in waiting),
+                      self.state.tick - waiting[0][0] if waiting else 0]
+        return tuple(waits)
+
+    def observe(self, reward, ticks=1, waits=None):
+        return (self.state.num_cars_waiting_ns, self.state.num_cars_waiting_ew, reward,
+                tuple(self.state.getLegalActions()), ticks, waits)
+
+
+class MacroStepEnv(ReferenceEnv):
+    """
+    TFState advanced through macroStep, i.e. through the running-minimum
+    queue update of advanceQueues, over stretches of up to maxTicks ticks.
+    """
+    maxTicks = 20
+
+    def step(self, action, arrivals):
+        counts = iter(arrivals)
+        self.state.sampleArrivals = lambda: next(counts)
+        _, reward, ticks = self.state.macroStep(action, maxTicks=len(arrivals))
+        return self.observe(reward, ticks)
+
+
+class VehicleTrackingEnv(ReferenceEnv):
+    """
+    TFState with per-vehicle tracking enabled; counts must not change and
+    the VehicleTracker's wait statistics must match the FIFO model.
+    """
+    def reset(self, start):
+        ReferenceEnv.reset(self, start)
+        self.tracker = self.state.enableVehicleTracking()
+
+    def step(self, action, arrivals):
+        self.state.sampleArrivals = lambda: arrivals[0]
+        self.state.updateState(action)
+        stats = self.tracker.getStats(self.state.tick)
+        waits = []
+        for direction in ('ns', 'ew'):
+            stat = stats[direction]
+            waits += [stat['served'], stat['mean_wait'], stat['max_wait'], stat['waiting'], stat['longest_waiting']]
+        return self.observe(self.state.getReward(), 1, tuple(waits))
+
+
+class PhaseEngineEnv:
+    """
+    One intersection of a PhaseEngine running the two-phase plan.
+    """
+    maxTicks = 1
+
+    def __init__(self, reward_type='initial'):
+        self.engine = PhaseEngine(twoPhasePlan(), 1, reward_type)
+
+    def reset(self, start):
+        engine = self.engine
+        plan = engine.plan
+        engine.ticks_per_episode = start.ticks_per_episode
+        engine.reset(queues=[[start.num_cars_waiting_ns, start.num_cars_waiting_ew]])
+        phase = 0 if start.light_color_ns == 'GREEN' else 1
+        engine.signal[0] = plan.greenStart[phase] + min(start.ticks_since_last_switch, plan.phases[phase].maxGreen)
+        engine.tick[0] = start.tick
+        engine.lastPenalty[0] = start.last_action_penalty
+
+    def step(self, action, arrivals):
+        reward = self.engine.step([ACTIONS.index(action)], [arrivals[0]])[0]
+        legal = self.engine.legalMask()[0]
+        ns, ew = self.engine.queues[0].tolist()
+        return ns, ew, reward.item(), tuple(a for a, ok in zip(ACTIONS, legal) if ok), 1, None
+
+
+class AgentAdapter:
+    """
+    A QLearningAgent-like agent (update and getQValue on TFStates).
+    """
+    def __init__(self, agent):
+        self.agent = agent
+
+    def update(self, state, action, nextState, reward):
+        self.agent.update(state, action, nextState, reward)
+
+    def getQValue(self, state, action):
+        return self.agent.getQValue(state, action)
+
+
+class BatchLearnerAdapter:
+    """
+    A BatchQLearner fed one transition at a time.
+    """
+    def __init__(self, learner):
+        self.learner = learner
+
+    def update(self, state, action, nextState, reward):
+        encode = self.learner.encoder.encode
+        self.learner.update(np.array([encode(state)]), np.array([ACTIONS.index(action)]), np.array([reward]),
+                            np.array([encode(nextState)]))
+
+    def getQValue(self, state, action):
+        return float(self.learner.table[self.learner.encoder.encode(state), ACTIONS.index(action)])
+
+
+class ServedAdapter(AgentAdapter):
+    """
+    An agent whose Q-values are read back through the decision server's
+    BatchPolicy instead of its own getQValue.
+    """
+    def __init__(self, agent):
+        AgentAdapter.__init__(self, agent)
+        self.policy = BatchPolicy(agent)
+
+    def getQValue(self, state, action):
+        return float(self.policy.computeQValues([state])[ACTIONS.index(action)])
+
+
+class Divergence:
+    """
+    A minimized diverging trace. rows holds, per step, the input and
+    the reference and alternative results; the last row diverges.
+    """
+    def __init__(self, kind, name, field, start, rows):
+        self.kind = kind
+        self.name = name
+        self.field = field
+        self.start = start
+        self.rows = rows
+
+    def __str__(self):
+        lines = [f"{self.name}: {self.kind} diverges in {self.field} after {len(self.rows)} step(s)"]
+        if self.start is not None:
+            lines.append(f"  start: {self.start}")
+        for i, (step, reference, alternative) in enumerate(self.rows):
+            marker = '  <-- diverges' if i == len(self.rows) - 1 else ''
+            lines.append(f"  {i}: {step}  reference={reference}  alternative={alternative}{marker}")
+        return '\n'.join(lines)
+
+
+class DivergenceError(AssertionError):
+    def __init__(self, divergence):
+        AssertionError.__init__(self, str(divergence))
+        self.divergence = divergence
+
+
+def close(a, b, rtol, atol):
+    return abs(a - b) <= atol + rtol * abs(b)
+
+
+def mismatch(reference, alternative, rtol, atol):
+    """
+    Name of the first field of two observations that differs, or None.
+    """
+    for field, a, b in zip(('ns', 'ew', 'reward', 'legal', 'ticks', 'waits'), reference, alternative):
+        if field == 'legal':
+            if tuple(a) != tuple(b):
+                return field
+        elif field == 'waits':
+            if b is not None and not all(close(y, x, rtol, atol) for x, y in zip(a, b)):
+                return field
+        elif not close(b, a, rtol, atol):
+            return field
+    return None
+
+
+def replayEngines(makeAlternative, reward_type, start, steps, rtol, atol):
+    """
+    Replays steps of (action, arrivals) from start in the reference and a
+    fresh alternative. Returns (index of the first diverging step or None,
+    field, rows).
+    """
+    reference = ReferenceEnv(reward_type)
+    alternative = makeAlternative(reward_type)
+    reference.reset(start)
+    alternative.reset(start)
+    rows = []
+    for i, (action, arrivals) in enumerate(steps):
+        expected = reference.step(action, arrivals)
+        actual = alternative.step(action, arrivals)
+        rows.append(((action, arrivals), expected, actual))
+        field = mismatch(expected, actual, rtol, atol)
+        if field is not None:
+            return i, field, rows
+    return None, None, rows
+
+
+def compareEngines(makeAlternative, reward_type='initial', ticks=5000, seed=0, rtol=0.0, atol=1e-9, name=None):
+    """
+    Runs the reference and makeAlternative(reward_type) for ticks ticks
+    with the same seeded arrivals and random legal actions, in stretches
+    of a random length up to the alternative's maxTicks, comparing queues,
+    reward, legal actions, ticks and (if tracked) vehicle waits after
+    every stretch. Raises DivergenceError with a minimized trace (the
+    latest start state that still diverges, as few non-zero arrivals as
+    possible) on the first mismatch.
+    """
+    name = name or getattr(makeAlternative, '__name__', 'alternative')
+    chooser = random.Random(seed + 1)
+    start = TFState('RED', 'GREEN', chooser.randint(0, 5), chooser.randint(0, 5), reward_type)
+    reference = ReferenceEnv(reward_type)
+    alternative = makeAlternative(reward_type)
+    reference.reset(start)
+    alternative.reset(start)
+    snapshots = []
+    steps = []
+    legal = tuple(start.getLegalActions())
+    arrivals = seededArrivals(seed, ticks, start.ticks_per_episode)
+    position = 0
+    while position < len(arrivals):
+        snapshots.append(reference.snapshot())
+        action = chooser.choice(legal)
+        stretch = arrivals[position:position + chooser.randint(1, alternative.maxTicks)]
+        expected = reference.step(action, stretch)
+        # Keep only the ticks the stretch used, so replays take the same
+        # stretches
+        steps.append((action, tuple(stretch[:expected[4]])))
+        position += expected[4]
+        actual = alternative.step(*steps[-1])
+        if mismatch(expected, actual, rtol, atol) is not None:
+            raise DivergenceError(minimizeEngineTrace(makeAlternative, reward_type, snapshots, steps, rtol, atol,
+                                                      name))
+        legal = expected[3]
+
+
+def minimizeEngineTrace(makeAlternative, reward_type, snapshots, steps, rtol, atol, name):
+    """
+    Starts from the latest reference state from which the replay still
+    diverges, then zeroes every arrival that is not needed to diverge.
+    """
+    for k in range(len(steps) - 1, -1, -1):
+        index, _, _ = replayEngines(makeAlternative, reward_type, snapshots[k], steps[k:], rtol, atol)
+        if index is not None:
+            start = snapshots[k]
+            steps = steps[k:k + index + 1]
+            break
+    i = 0
+    while i < len(steps):
+        action, arrivals = steps[i]
+        for j in range(len(arrivals)):
+            if arrivals[j]:
+                zeroed = arrivals[:j] + (0,) + arrivals[j + 1:]
+                candidate = steps[:i] + [(action, zeroed)] + steps[i + 1:]
+                index, _, _ = replayEngines(makeAlternative, reward_type, start, candidate, rtol, atol)
+                if index is not None:
+                    steps = candidate[:index + 1]
+                    arrivals = zeroed
+                    if i >= len(steps):
+                        break
+        i += 1
+    index, field, rows = replayEngines(makeAlternative, reward_type, start, steps, rtol, atol)
+    return Divergence('engine', name, field, start, rows[:index + 1])
+
+
+def ddmin(items, fails):
+    """
+    Delta debugging: a small subsequence of items for which fails still
+    holds (1-minimal with respect to removing chunks).
+    """
+    granularity = 2
+    while len(items) >= 2:
+        chunk = math.ceil(len(items) / granularity)
+        for i in range(0, len(items), chunk):
+            complement = items[:i] + items[i + chunk:]
+            if complement and fails(complement):
+                items = complement
+                granularity = max(granularity - 1, 2)
+                break
+        else:
+            if granularity >= len(items):
+                break
+            granularity = min(len(items), 2 * granularity)
+    return items
+
+
+def replayAgents(makeReference, makeAlternative, transitions, rtol, atol):
+    """
+    Feeds transitions to fresh agents and compares Q(state, action) after
+    every update and the Q-values of the next state. Returns (index of the
+    first diverging transition or None, rows).
+    """
+    reference = makeReference()
+    alternative = makeAlternative()
+    rows = []
+    for i, (state, action, nextState, reward) in enumerate(transitions):
+        reference.update(state, action, nextState, reward)
+        alternative.update(state, action, nextState, reward)
+        probes = [(state, action)] + [(nextState, a) for a in nextState.getLegalActions()]
+        expected = [reference.getQValue(s, a) for s, a in probes]
+        actual = [alternative.getQValue(s, a) for s, a in probes]
+        rows.append(((str(state), action, reward), expected, actual))
+        if not all(close(b, a, rtol, atol) for a, b in zip(expected, actual)):
+            return i, rows
+    return None, rows
+
+
+def referenceTransitions(reward_type='initial', ticks=5000, seed=0):
+    """
+    (state, action, next state, reward) of a seeded reference run with
+    random legal actions.
+    """
+    chooser = random.Random(seed + 1)
+    env = ReferenceEnv(reward_type)
+    env.reset(TFState('RED', 'GREEN', chooser.randint(0, 5), chooser.randint(0, 5), reward_type))
+    transitions = []
+    for arrivals in seededArrivals(seed, ticks):
+        state = env.snapshot()
+        action = chooser.choice(state.getLegalActions())
+        reward = env.step(action, (arrivals,))[2]
+        transitions.append((state, action, env.snapshot(), reward))
+    return transitions
+
+
+def compareParameters(makeAgent, reward_type='initial', ticks=5000, seed=0, every=100, name=None):
+    """
+    Feeds the transitions of a seeded reference run to makeAgent() and,
+    every `every` updates, compares convergence.getParameters with the
+    values its tables hold per key. Raises DivergenceError on mismatch
+    (including getParameters failing).
+    """
+    name = name or getattr(makeAgent, '__name__', 'agent')
+    agent = makeAgent()
+    for i, (state, action, nextState, reward) in enumerate(referenceTransitions(reward_type, ticks, seed)):
+        agent.update(state, action, nextState, reward)
+        if i % every:
+            continue
+        keys = agent.qValues.keys()
+        expected = [[table[key] for key in keys] for table in (agent.qValues, agent.qValuesB)]
+        try:
+            actual = getParameters(agent).tolist()
+        except ValueError as e:
+            actual = str(e)
+        if actual != expected:
+            raise DivergenceError(Divergence('parameters', name, 'getParameters', None,
+                                             [((i, len(keys)), expected, actual)]))
+
+
+def compareAgents(makeReference, makeAlternative, reward_type='initial', ticks=5000, seed=0, rtol=1e-9, atol=1e-9,
+                  name=None):
+    """
+    Feeds the transitions of a seeded reference run (random legal actions)
+    to makeReference() and makeAlternative() agents. Raises
+    DivergenceError with a ddmin-minimized transition list on mismatch.
+    """
+    name = name or getattr(makeAlternative, '__name__', 'alternative')
+    transitions = referenceTransitions(reward_type, ticks, seed)
+    index, _ = replayAgents(makeReference, makeAlternative, transitions, rtol, atol)
+    if index is None:
+        return
+    fails = lambda subset: replayAgents(makeReference, makeAlternative, subset, rtol, atol)[0] is not None
+    transitions = ddmin(transitions[:index + 1], fails)
+    index, rows = replayAgents(makeReference, makeAlternative, transitions, rtol, atol)
+    raise DivergenceError(Divergence('agent', name, 'Q-values', None, rows[:index + 1]))
+
+
+def runAll(ticks=5000, seed=0):
+    """
+    Checks every alternative engine and learner in the tree. Returns the
+    list of DivergenceErrors (empty if everything matches).
+    """
+    failures = []
+    for makeAlternative in (MacroStepEnv, VehicleTrackingEnv, PhaseEngineEnv):
+        for reward_type in REWARD_TYPES:
+            try:
+                compareEngines(makeAlternative, reward_type, ticks, seed)
+                print(f"OK   {makeAlternative.__name__} ({reward_type})")
+            except DivergenceError as e:
+                print(f"FAIL {e}")
+                failures.append(e)
+
+    encoder = TFStateEncoder()
+    spill = tempfile.mkdtemp()
+    spills = itertools.count()
+    agents = {
+        'BoundedQTable (lru, spill)': (
+            lambda: AgentAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8)),
+            lambda: AgentAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8, qTable=BoundedQTable(
+                64, 'lru', spillPath=os.path.join(spill, f'spill{next(spills)}'))))),
+        'BoundedQTable (lfu)': (
+            lambda: AgentAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8)),
+            lambda: AgentAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8, qTable=BoundedQTable(
+                10 ** 6, 'lfu')))),
+        'BatchQLearner': (
+            lambda: AgentAdapter(EncodedQAgent(np.zeros((encoder.numStates, 2)), encoder, alpha=0.2, epsilon=0.0,
+                                               gamma=0.8)),
+            lambda: BatchLearnerAdapter(BatchQLearner(encoder, alpha=0.2, epsilon=0.0, gamma=0.8))),
+        'DecisionServer (BatchQLearner.getAgent)': (
+            lambda: AgentAdapter(EncodedQAgent(np.zeros((encoder.numStates, 2)), encoder, alpha=0.2, epsilon=0.0,
+                                               gamma=0.8)),
+            lambda: ServedAdapter(BatchQLearner(encoder).getAgent(alpha=0.2, epsilon=0.0, gamma=0.8))),
+        'DecisionServer (QLearningAgent)': (
+            lambda: AgentAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8)),
+            lambda: ServedAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8))),
+        'DecisionServer (BoundedQTable)': (
+            lambda: AgentAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8)),
+            lambda: ServedAdapter(QLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8, qTable=BoundedQTable(
+                10 ** 6, 'lru')))),
+    }
+    try:
+        for name, (makeReference, makeAlternative) in agents.items():
+            try:
+                compareAgents(makeReference, makeAlternative, 'initial', ticks, seed, name=name)
+                print(f"OK   {name}")
+            except DivergenceError as e:
+                print(f"FAIL {e}")
+                failures.append(e)
+    finally:
+        shutil.rmtree(spill, ignore_errors=True)
+
+    def unequalDoubleQ():
+        # The second table starts with a larger array than the first
+        agent = DoubleQLearningAgent(alpha=0.2, epsilon=0.0, gamma=0.8)
+        agent.qValuesB.reserve(1000)
+        return agent
+    try:
+        compareParameters(unequalDoubleQ, 'initial', ticks, seed, name='getParameters (Double Q)')
+        print("OK   getParameters (Double Q)")
+    except DivergenceError as e:
+        print(f"FAIL {e}")
+        failures.append(e)
+    return failures
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(1 if runAll() else 0)
@@ -0,0 +1,371 @@
+"""
+Parameter-server training of TrafficApproximateQAgent: actors on any
+node push compressed weight deltas to a ParameterServer and pull its
+weights back (asynchronous SGD). ParameterServerTrainer runs everything
+on localhost; `python distributed_training.py server|actor` spans nodes.
+"""
+
+import asyncio
+import json
+import multiprocessing as mp
+import random
+import socket
+import struct
+import time
+import zlib
+import numpy as np
+from agents import saveAgent
+from states import TFState
+from feature_specs import SpecFeatureExtractor
+from qlearning_agents import TrafficApproximateQAgent
+from traffic_lights import run_episode
+
+# Messages are a MESSAGE header (kind, payload length) and a payload:
+#   b'G'             pull  -> b'W' + uint64 version + weights
+#   b'P' + delta     push
+#   b'E' + JSON      episode report (actor, episode, reward, elapsed)
+#   b'D'             actor done
+#   b'F' + JSON      actor failed (actor, error)
+#   b'S'             stats -> b'J' + JSON
+MESSAGE = struct.Struct('<cI')
+VERSION = struct.Struct('<Q')
+COUNT = struct.Struct('<I')
+# Value type of pushed deltas per compression; all but 'none' are zlib
+# compressed. Actors keep the fp16 rounding error and add it to their
+# next push (error feedback). Pulled weights are always float64.
+COMPRESSIONS = {'none': np.float64, 'zlib': np.float32, 'fp16': np.float16}
+
+
+def makeAgent(agentArgs, extractor=None):
+    """
+    The agent every role builds from the same arguments, with its feature
+    vocabulary fixed so indices agree across processes.
+    """
+    agent = TrafficApproximateQAgent(extractor=extractor if extractor is not None else SpecFeatureExtractor(),
+                                     **agentArgs)
+    agent.fixFeatureVocabulary()
+    return agent
+
+
+def encodeDelta(indices, values, compression):
+    payload = COUNT.pack(len(indices)) + indices.astype(np.int32).tobytes() + \
+        values.astype(COMPRESSIONS[compression]).tobytes()
+    return payload if compression == 'none' else zlib.compress(payload, 1)
+
+
+def decodeDelta(payload, compression):
+    if compression != 'none':
+        payload = zlib.decompress(payload)
+    count, = COUNT.unpack_from(payload)
+    indices = np.frombuffer(payload, dtype=np.int32, count=count, offset=COUNT.size)
+    values = np.frombuffer(payload, dtype=COMPRESSIONS[compression], count=count, offset=COUNT.size + 4 * count)
+    return indices, values.astype(np.float64)
+
+
+def encodeWeights(version, weights, compression):
+    payload = VERSION.pack(version) + weights.astype(np.float64).tobytes()
+    return payload if compression == 'none' else zlib.compress(payload, 1)
+
+
+def decodeWeights(payload, compression):
+    if compression != 'none':
+        payload = zlib.decompress(payload)
+    version, = VERSION.unpack_from(payload)
+    return version, np.frombuffer(payload, dtype=np.float64, offset=VERSION.size).copy()
+
+
+class ParameterServer:
+    """
+    asyncio server holding the weights of `agent`. If numActors is given,
+    finished is set once that many actors have sent b'D'.
+    """
+    def __init__(self, agent, compression='zlib', numActors=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.agent = agent
+        self.numFeatures = agent.fixFeatureVocabulary()
+        self.weights = agent.weights.values[:self.numFeatures]
+        self.compression = compression
+        self.numActors = numActors
+        self.version = 0
+        self.done = 0
+        # (actor id, error) of the actors that sent b'F'
+        self.failures = []
+        self.finished = asyncio.Event()
+        # actor id -> list of (episode, reward, seconds since the actor started)
+        self.curves = {}
+        self.stats = {'pushes': 0, 'pulls': 0, 'bytes_in': 0, 'bytes_out': 0, 'raw_bytes_in': 0}
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                kind, length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+                payload = await reader.readexactly(length)
+                self.stats['bytes_in'] += MESSAGE.size + length
+                if kind == b'P':
+                    indices, values = decodeDelta(payload, self.compression)
+                    self.weights[indices] += values
+                    self.version += 1
+                    self.stats['pushes'] += 1
+                    self.stats['raw_bytes_in'] += 12 * len(indices)
+                elif kind == b'G':
+                    self.send(writer, b'W', encodeWeights(self.version, self.weights, self.compression))
+                    self.stats['pulls'] += 1
+                elif kind == b'E':
+                    report = json.loads(payload)
+                    self.curves.setdefault(report['actor'], []).append(
+                        (report['episode'], report['reward'], report['elapsed']))
+                elif kind == b'S':
+                    self.send(writer, b'J', json.dumps(self.getStats()).encode())
+                elif kind in (b'D', b'F'):
+                    if kind == b'F':
+                        report = json.loads(payload)
+                        self.failures.append((report['actor'], report['error']))
+                    self.done += 1
+                    if self.numActors is not None and self.done >= self.numActors:
+                        self.finished.set()
+                else:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        writer.close()
+
+    def send(self, writer, kind, payload):
+        writer.write(MESSAGE.pack(kind, len(payload)) + payload)
+        self.stats['bytes_out'] += MESSAGE.size + len(payload)
+
+    def getStats(self):
+        stats = dict(self.stats, version=self.version, actors_done=self.done, actors_failed=len(self.failures))
+        stats['push_compression'] = stats['raw_bytes_in'] / max(stats['bytes_in'], 1)
+        return stats
+
+
+class ParameterClient:
+    """
+    Blocking client used by the actors.
+    """
+    def __init__(self, host, port, compression='zlib'):
+        self.socket = socket.create_connection((host, port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.compression = compression
+
+    def send(self, kind, payload=b''):
+        self.socket.sendall(MESSAGE.pack(kind, len(payload)) + payload)
+
+    def receive(self, size):
+        chunks = []
+        while size:
+            chunk = self.socket.recv(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("Parameter server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def reply(self):
+        _, length = MESSAGE.unpack(self.receive(MESSAGE.size))
+        return self.receive(length)
+
+    def pull(self):
+        """
+        Returns (version, weights).
+        """
+        self.send(b'G')
+        return decodeWeights(self.reply(), self.compression)
+
+    def push(self, delta):
+        """
+        Sends the non-zero entries of a dense delta. Returns the part of
+        the delta lost to compression, for error feedback.
+        """
+        indices = np.flatnonzero(delta)
+        values = delta[indices]
+        self.send(b'P', encodeDelta(indices, values, self.compression))
+        residual = np.zeros_like(delta)
+        residual[indices] = values - values.astype(COMPRESSIONS[self.compression])
+        return residual
+
+    def report(self, actor, episode, reward, elapsed):
+        self.send(b'E', json.dumps({'actor': actor, 'episode': episode, 'reward': reward,
+                                    'elapsed': elapsed}).encode())
+
+    def getStats(self):
+        self.send(b'S')
+        return json.loads(self.reply())
+
+    def fail(self, actor, error):
+        self.send(b'F', json.dumps({'actor': actor, 'error': error}).encode())
+
+    def close(self, done=True):
+        if done:
+            self.send(b'D')
+        self.socket.close()
+
+
+def runActor(actorId, host, port, config):
+    """
+    Runs config['episodes'] episodes against the server at host:port.
+    Sends b'D' when done; on an error reports it with b'F' and re-raises.
+    """
+    random.seed(config['seed'] + actorId)
+    agent = makeAgent(config['agentArgs'], config['extractor'])
+    client = ParameterClient(host, port, config['compression'])
+    try:
+        # The weight array may have room beyond the vocabulary; only the
+        # first numFeatures entries are exchanged with the server
+        weights = agent.weights.values[:agent.fixFeatureVocabulary()]
+        _, weights[:] = client.pull()
+        base = weights.copy()
+        residual = np.zeros_like(weights)
+        pushes = 0
+        started = time.perf_counter()
+        for episode in range(config['episodes']):
+            state = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), config['reward_type'])
+            agent.startEpisode()
+            total_reward = 0
+            step = 0
+            while step < config['steps_per_episode']:
+                ticks = min(config['pushEvery'], config['steps_per_episode'] - step)
+                reward, _ = run_episode(agent, state, ticks, {'ns': [], 'ew': []})
+                total_reward += reward
+                step += ticks
+                residual = client.push(weights - base + residual)
+                base = weights.copy()
+                pushes += 1
+                if pushes % config['pullEvery'] == 0:
+                    _, weights[:] = client.pull()
+                    base = weights.copy()
+            agent.stopEpisode()
+            client.report(actorId, episode, total_reward, time.perf_counter() - started)
+    except BaseException as e:
+        try:
+            client.fail(actorId, f"{type(e).__name__}: {e}")
+        except OSError:
+            pass
+        client.close(done=False)
+        raise
+    client.close()
+
+
+class ParameterServerTrainer:
+    """
+    Runs a ParameterServer and numActors actor processes on this machine.
+
+    pushEvery   - ticks between two pushes of an actor
+    pullEvery   - pushes between two pulls of an actor; 1 and 1 is close
+                  to synchronous training, larger intervals trade
+                  staleness for less traffic
+    compression - 'none', 'zlib' or 'fp16' (see COMPRESSIONS)
+    agentArgs   - passed on to TrafficApproximateQAgent (alpha, optimizer, ...)
+    """
+    def __init__(self, numActors=2, episodes=5, steps_per_episode=1000, reward_type='initial', host='127.0.0.1',
+                 port=0, pushEvery=100, pullEvery=1, compression='zlib', extractor=None, seed=0, **agentArgs):
+        self.numActors = numActors
+        self.host = host
+        self.port = port
+        self.config = {
+            'episodes': episodes,
+            'steps_per_episode': steps_per_episode,
+            'reward_type': reward_type,
+            'pushEvery': pushEvery,
+            'pullEvery': pullEvery,
+            'compression': compression,
+            'extractor': extractor,
+            'seed': seed,
+            'agentArgs': agentArgs,
+        }
+        self.server = None
+        self.elapsed = 0.0
+
+    def train(self):
+        """
+        Trains to completion and returns the server's agent. Raises
+        RuntimeError if an actor failed.
+        """
+        asyncio.run(self.run())
+        return self.server.agent
+
+    async def run(self):
+        self.server = ParameterServer(makeAgent(self.config['agentArgs'], self.config['extractor']),
+                                      self.config['compression'], self.numActors)
+        await self.server.start(self.host, self.port)
+        started = time.perf_counter()
+        actors = [mp.Process(target=runActor, args=(i, self.host, self.server.port, self.config))
+                  for i in range(self.numActors)]
+        for actor in actors:
+            actor.start()
+        # Actors that die before they can report never send b'F'
+        while not self.server.finished.is_set() and any(actor.is_alive() for actor in actors):
+            try:
+                await asyncio.wait_for(self.server.finished.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+        loop = asyncio.get_running_loop()
+        for actor in actors:
+            await loop.run_in_executor(None, actor.join)
+        self.elapsed = time.perf_counter() - started
+        self.server.server.close()
+        await self.server.server.wait_closed()
+        failed = [(i, actor.exitcode) for i, actor in enumerate(actors) if actor.exitcode != 0]
+        if self.server.failures or failed:
+            errors = '; '.join(f"actor {actor}: {error}" for actor, error in self.server.failures)
+            raise RuntimeError(f"Actors failed (exit codes {failed}): {errors}")
+
+    def learningCurve(self):
+        """
+        All episodes of all actors as (seconds since start, total reward).
+        """
+        return sorted((elapsed, reward) for curve in self.server.curves.values() for _, reward, elapsed in curve)
+
+
+AGENT_ARGS = {'alpha': 0.05, 'epsilon': 0.05, 'gamma': 0.8, 'optimizer': 'rmsprop'}
+
+
+async def serve(host, port, compression, statsInterval=10.0, savePath=None):
+    server = ParameterServer(makeAgent(AGENT_ARGS), compression)
+    await server.start(host, port)
+    print(f"Parameter server on {host}:{server.port}")
+    while True:
+        await asyncio.sleep(statsInterval)
+        print(server.getStats())
+        if savePath is not None:
+            saveAgent(server.agent, savePath)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Parameter-server training of the approximate agent.')
+    parser.add_argument('role', choices=['local', 'server', 'actor'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--actors', type=int, default=2, help="number of actors ('local')")
+    parser.add_argument('--actor-id', type=int, default=0, help="this actor's id ('actor'), also seeds it")
+    parser.add_argument('--episodes', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--push-every', type=int, default=100)
+    parser.add_argument('--pull-every', type=int, default=1)
+    parser.add_argument('--compression', default='zlib', choices=sorted(COMPRESSIONS))
+    parser.add_argument('--save', default=None, help="save the agent here ('server' and 'local')")
+    args = parser.parse_args()
+    if args.role == 'server':
+        asyncio.run(serve(args.host, args.port, args.compression, savePath=args.save))
+    elif args.role == 'actor':
+        runActor(args.actor_id, args.host, args.port, {
+            'episodes': args.episodes, 'steps_per_episode': args.steps, 'reward_type': 'initial',
+            'pushEvery': args.push_every, 'pullEvery': args.pull_every, 'compression': args.compression,
+            'extractor': None, 'seed': 0, 'agentArgs': AGENT_ARGS})
+    else:
+        trainer = ParameterServerTrainer(args.actors, args.episodes, args.steps, host=args.host, port=0,
+                                         pushEvery=args.push_every, pullEvery=args.pull_every,
+                                         compression=args.compression, **AGENT_ARGS)
+        agent = trainer.train()
+        print(f"{trainer.elapsed:.1f}s, {trainer.server.getStats()}")
+        print(trainer.learningCurve())
+        if args.save is not None:
+            saveAgent(agent, args.save)
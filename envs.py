@@ -0,0 +1,255 @@
+"""
+Gymnasium-style reset/step environments around TFState: TrafficEnv for
+one intersection, and SyncVectorEnv and SubprocVectorEnv for many in
+lockstep with stacked NumPy results and automatic resets.
+"""
+
+import multiprocessing as mp
+import os
+import random
+from functools import partial
+import numpy as np
+from states import TFState, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH, ACTIONS
+
+OBSERVATION_FIELDS = ('ns_green', 'ns', 'ew', 'ticks_since_last_switch', 'time_of_day')
+
+
+class TrafficEnv:
+    """
+    One TFState intersection as a reset/step environment.
+
+    max_steps   - steps after which an episode is truncated (episodes
+                  never terminate on their own)
+    encoder     - optional states.TFStateEncoder; observations are then
+                  encoded state indices
+    initialCars - initial queues are drawn from 0..initialCars, as in
+                  run_simulation
+    seed        - seed of the env's own random generator, which draws the
+                  initial queues and the arrivals
+
+    The current TFState is available as env.state, so the agents of this
+    repo can pick actions from it. Illegal actions raise ValueError.
+    """
+    def __init__(self, reward_type='initial', max_steps=4320, ticks_per_episode=4320, encoder=None,
+                 initialCars=5, seed=None):
+        self.reward_type = reward_type
+        self.max_steps = max_steps
+        self.ticks_per_episode = ticks_per_episode
+        self.encoder = encoder
+        self.initialCars = initialCars
+        self.random = random.Random(seed)
+        self.state = None
+        self.steps = 0
+
+    def observe(self):
+        state = self.state
+        if self.encoder is not None:
+            return np.int64(self.encoder.encode(state))
+        return np.array([state.light_color_ns == 'GREEN', state.num_cars_waiting_ns, state.num_cars_waiting_ew,
+                         state.ticks_since_last_switch, state.tick % self.ticks_per_episode], dtype=np.int64)
+
+    def legalMask(self):
+        """
+        Boolean mask of legal actions in ACTIONS order.
+        """
+        since = self.state.ticks_since_last_switch
+        return np.array([since >= MIN_TICKS_BEFORE_SWITCH, since < MAX_TICKS_BEFORE_SWITCH])
+
+    def reset(self, seed=None, options=None):
+        """
+        Starts a new episode. options may set 'queues' to (ns, ew) instead
+        of drawing them.
+        """
+        if seed is not None:
+            self.random.seed(seed)
+        if options is not None and 'queues' in options:
+            ns, ew = options['queues']
+        else:
+            ns, ew = self.random.randint(0, self.initialCars), self.random.randint(0, self.initialCars)
+        self.state = TFState('RED', 'GREEN', ns, ew, self.reward_type, self.ticks_per_episode)
+        self.state.random = self.random
+        self.steps = 0
+        return self.observe(), {'action_mask': self.legalMask()}
+
+    def step(self, action):
+        action = ACTIONS[action] if not isinstance(action, str) else action
+        if action not in self.state.getLegalActions():
+            raise ValueError(f"Illegal action {action} after {self.state.ticks_since_last_switch} ticks")
+        self.state.updateState(action)
+        self.steps += 1
+        truncated = self.max_steps is not None and self.steps >= self.max_steps
+        return self.observe(), self.state.getReward(), False, truncated, {'action_mask': self.legalMask()}
+
+
+class SyncVectorEnv:
+    """
+    Steps the envs built by envFns (callables without arguments) one
+    after the other in this process.
+    """
+    def __init__(self, envFns):
+        self.envs = [envFn() for envFn in envFns]
+        self.numEnvs = len(self.envs)
+
+    def reset(self, seed=None):
+        """
+        Resets every env. seed is None, an int (env i gets seed + i) or a
+        list with one seed per env. Returns (obs, infos).
+        """
+        if seed is None or isinstance(seed, int):
+            seeds = [None if seed is None else seed + i for i in range(self.numEnvs)]
+        else:
+            seeds = list(seed)
+        results = [env.reset(seed=s) for env, s in zip(self.envs, seeds)]
+        return np.stack([obs for obs, _ in results]), {'action_mask': np.stack([info['action_mask'] for _, info in results])}
+
+    def step(self, actions):
+        """
+        Steps env i with actions[i] and resets the envs whose episode
+        ended. Returns (obs, rewards, terminated, truncated, infos): obs
+        of a reset env is the first of its new episode,
+        infos['final_observation'] holds every env's observation before
+        any reset and infos['action_mask'] the legal actions for obs.
+        """
+        observations, finals, masks = [], [], []
+        rewards = np.empty(self.numEnvs)
+        terminated = np.empty(self.numEnvs, dtype=bool)
+        truncated = np.empty(self.numEnvs, dtype=bool)
+        for i, (env, action) in enumerate(zip(self.envs, np.asarray(actions).tolist())):
+            obs, rewards[i], terminated[i], truncated[i], info = env.step(action)
+            finals.append(obs)
+            if terminated[i] or truncated[i]:
+                obs, info = env.reset()
+            observations.append(obs)
+            masks.append(info['action_mask'])
+        infos = {'action_mask': np.stack(masks), 'final_observation': np.stack(finals)}
+        return np.stack(observations), rewards, terminated, truncated, infos
+
+    def close(self):
+        pass
+
+
+def runWorker(connection, envFns):
+    envs = SyncVectorEnv(envFns)
+    try:
+        while True:
+            command, data = connection.recv()
+            if command == 'close':
+                break
+            try:
+                result = envs.step(data) if command == 'step' else envs.reset(data)
+            except Exception as e:
+                connection.send((False, e))
+            else:
+                connection.send((True, result))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        connection.close()
+
+
+class SubprocVectorEnv:
+    """
+    Runs the envs built by envFns in numWorkers processes (at most one
+    per CPU by default). Every worker steps its contiguous share of the
+    envs as a SyncVectorEnv, so a step costs one message per worker
+    rather than one per env. envFns have to be picklable, e.g.
+    functools.partial(TrafficEnv, ...).
+    """
+    def __init__(self, envFns, numWorkers=None):
+        self.numEnvs = len(envFns)
+        numWorkers = min(numWorkers or os.cpu_count() or 1, self.numEnvs)
+        bounds = np.linspace(0, self.numEnvs, numWorkers + 1).astype(int)
+        self.slices = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+        self.connections = []
+        self.workers = []
+        self.broken = False
+        for share in self.slices:
+            connection, workerConnection = mp.Pipe()
+            worker = mp.Process(target=runWorker, args=(workerConnection, envFns[share]), daemon=True)
+            worker.start()
+            workerConnection.close()
+            self.connections.append(connection)
+            self.workers.append(worker)
+
+    def call(self, command, data):
+        """
+        Sends command with each worker's share of data and returns the
+        workers' results. Every reply is read before the first error is
+        raised, so the pipes stay in step; if a worker dies the env is
+        marked broken and refuses further calls.
+        """
+        if self.broken:
+            raise RuntimeError("SubprocVectorEnv is broken after a worker died; close it")
+        try:
+            for connection, share in zip(self.connections, self.slices):
+                connection.send((command, data[share]))
+            replies = [connection.recv() for connection in self.connections]
+        except (EOFError, BrokenPipeError, OSError):
+            self.broken = True
+            raise
+        for ok, result in replies:
+            if not ok:
+                raise result
+        return [result for _, result in replies]
+
+    def reset(self, seed=None):
+        """
+        As SyncVectorEnv.reset.
+        """
+        if seed is None or isinstance(seed, int):
+            seeds = [None if seed is None else seed + i for i in range(self.numEnvs)]
+        else:
+            seeds = list(seed)
+        results = self.call('reset', seeds)
+        obs = np.concatenate([obs for obs, _ in results])
+        return obs, {'action_mask': np.concatenate([infos['action_mask'] for _, infos in results])}
+
+    def step(self, actions):
+        """
+        As SyncVectorEnv.step.
+        """
+        results = self.call('step', np.asarray(actions))
+        obs, rewards, terminated, truncated = (np.concatenate([result[i] for result in results]) for i in range(4))
+        infos = {key: np.concatenate([result[4][key] for result in results]) for key in results[0][4]}
+        return obs, rewards, terminated, truncated, infos
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(('close', None))
+            except (BrokenPipeError, OSError):
+                pass
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+        self.connections = []
+        self.workers = []
+
+
+def makeVectorEnv(numEnvs, subprocess=False, numWorkers=None, seed=None, **envArgs):
+    """
+    A vector env of numEnvs TrafficEnvs built with envArgs; env i gets
+    seed + i if seed is given.
+    """
+    envFns = [partial(TrafficEnv, seed=None if seed is None else seed + i, **envArgs) for i in range(numEnvs)]
+    if subprocess:
+        return SubprocVectorEnv(envFns, numWorkers)
+    return SyncVectorEnv(envFns)
+
+
+if __name__ == '__main__':
+    import time
+    for subprocess in (False, True):
+        envs = makeVectorEnv(256, subprocess=subprocess, seed=0, max_steps=1000)
+        rng = np.random.default_rng(0)
+        obs, infos = envs.reset()
+        started = time.perf_counter()
+        total = 0.0
+        for _ in range(1000):
+            # Random legal actions
+            actions = np.argmax(infos['action_mask'] * rng.random(infos['action_mask'].shape), axis=1)
+            obs, rewards, terminated, truncated, infos = envs.step(actions)
+            total += rewards.mean()
+        elapsed = time.perf_counter() - started
+        envs.close()
+        print(f"{type(envs).__name__}: {256 * 1000 / elapsed:,.0f} steps/s, mean reward per tick {total / 1000:.2f}")
@@ -41,4 +41,48 @@ class TrafficLightExtractor:
         # Absolute imbalance (to penalize high disparity regardless of light)
         features['imbalance'] = abs(diff)
 
-        return features
\ No newline at end of file
+        return features
+
+
+class NormalizedFeatureExtractor(FeatureExtractor):
+    """
+    Wraps another extractor and divides every feature by the running RMS
+    of its observed values. Car counts grow into the tens while
+    indicators stay at 1.0, which is what forced the tiny alpha for the
+    approximate agent; after scaling all features are O(1).
+
+    Statistics only change through observe(), so Q-values computed
+    between two updates are consistent, and not at all after freeze().
+    """
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self.sumSquares = util.Counter()
+        self.count = 0
+        self.frozen = False
+
+    def getFeatures(self, state, action):
+        features = self.extractor.getFeatures(state, action)
+        if self.count == 0:
+            return features
+        scaled = util.Counter()
+        for feature, value in features.items():
+            meanSquare = self.sumSquares[feature] / self.count
+            scaled[feature] = value / meanSquare ** 0.5 if meanSquare > 0 else value
+        return scaled
+
+    def observe(self, state, action):
+        """
+        Updates the running statistics with the raw features of (state,
+        action), unless frozen.
+        """
+        if self.frozen:
+            return
+        self.count += 1
+        for feature, value in self.extractor.getFeatures(state, action).items():
+            self.sumSquares[feature] += value * value
+
+    def freeze(self):
+        """
+        Keeps the current scaling from now on (e.g. for test episodes).
+        """
+        self.frozen = True
@@ -0,0 +1,239 @@
+"""
+Declarative features for approximate Q-learning: a FeatureSpec lays out
+encoders (tile coding, RBFs, crosses with the action or phase) over
+TFState signals as fixed blocks of one sparse feature vector.
+"""
+
+import math
+import numpy as np
+import util
+from feature_extractors import FeatureExtractor
+from states import ACTIONS
+
+
+
+def _timeOfDay(state):
+    return (state.tick % state.ticks_per_episode) / float(state.ticks_per_episode)
+
+
+SIGNALS = {
+    'queue_ns': lambda state: state.num_cars_waiting_ns,
+    'queue_ew': lambda state: state.num_cars_waiting_ew,
+    'queue_total': lambda state: state.num_cars_waiting_ns + state.num_cars_waiting_ew,
+    'queue_diff': lambda state: state.num_cars_waiting_ns - state.num_cars_waiting_ew,
+    'phase': lambda state: 1 if state.light_color_ns == 'GREEN' else 0,
+    'ticks_since_last_switch': lambda state: state.ticks_since_last_switch,
+    'time_of_day': _timeOfDay,
+}
+
+# Cardinality of the discrete signals that encoders can be crossed with
+DISCRETE_SIZES = {
+    'action': len(ACTIONS),
+    'phase': 2,
+}
+
+
+class Encoder:
+    """
+    Maps signal values to a block of `size` features. encode() appends
+    (index, value) pairs relative to the start of the block.
+    """
+    signals = ()
+    size = 0
+
+    def encode(self, signals, indices, values, offset):
+        util.raiseNotDefined()
+
+
+class Bias(Encoder):
+    size = 1
+
+    def encode(self, signals, indices, values, offset):
+        indices.append(offset)
+        values.append(1.0)
+
+
+class Raw(Encoder):
+    """
+    The signal itself, multiplied by `scale`.
+    """
+    size = 1
+
+    def __init__(self, signal, scale=1.0):
+        self.signals = (signal,)
+        self.scale = float(scale)
+
+    def encode(self, signals, indices, values, offset):
+        indices.append(offset)
+        values.append(signals[self.signals[0]] * self.scale)
+
+
+class OneHot(Encoder):
+    """
+    Indicator of an integer signal in [0, numValues), clipped at both ends.
+    """
+    def __init__(self, signal, numValues):
+        self.signals = (signal,)
+        self.size = int(numValues)
+
+    def encode(self, signals, indices, values, offset):
+        value = min(max(int(signals[self.signals[0]]), 0), self.size - 1)
+        indices.append(offset + value)
+        values.append(1.0)
+
+
+class TileCoding(Encoder):
+    """
+    Grid tile coding over one or more continuous signals.
+
+    The box [lows, highs] is cut into tilesPerDim tiles along each signal,
+    repeated numTilings times with each tiling shifted by a fraction of a
+    tile (asymmetric offsets 1, 3, 5, ... per dimension). Exactly one tile
+    per tiling is active; values outside the box are clipped to its edge.
+    """
+    def __init__(self, signals, lows, highs, tilesPerDim, numTilings=4):
+        self.signals = tuple(signals)
+        self.lows = [float(x) for x in lows]
+        self.widths = [(float(h) - float(l)) / n for l, h, n in zip(lows, highs, tilesPerDim)]
+        # One extra tile per dimension absorbs the offset of shifted tilings
+        self.dims = [int(n) + 1 for n in tilesPerDim]
+        self.numTilings = int(numTilings)
+        self.tilesPerTiling = 1
+        for d in self.dims:
+            self.tilesPerTiling *= d
+        self.size = self.numTilings * self.tilesPerTiling
+        self.offsets = [[(2 * k + 1) * t / float(self.numTilings) for k in range(len(self.signals))]
+                        for t in range(self.numTilings)]
+
+    def encode(self, signals, indices, values, offset):
+        scaled = []
+        for k, signal in enumerate(self.signals):
+            x = (signals[signal] - self.lows[k]) / self.widths[k]
+            scaled.append(min(max(x, 0.0), self.dims[k] - 1.0))
+        for t in range(self.numTilings):
+            tile = 0
+            for k, x in enumerate(scaled):
+                coord = int(x + self.offsets[t][k] % 1.0)
+                tile = tile * self.dims[k] + min(coord, self.dims[k] - 1)
+            indices.append(offset + t * self.tilesPerTiling + tile)
+            values.append(1.0)
+
+
+class RBF(Encoder):
+    """
+    Gaussian radial basis functions of one signal:
+    exp(-(x - c)^2 / (2 * width^2)) for every center c.
+    """
+    def __init__(self, signal, centers, width):
+        self.signals = (signal,)
+        self.centers = [float(c) for c in centers]
+        self.size = len(self.centers)
+        self.denominator = 2.0 * float(width) ** 2
+
+    def encode(self, signals, indices, values, offset):
+        x = signals[self.signals[0]]
+        for i, c in enumerate(self.centers):
+            indices.append(offset + i)
+            values.append(math.exp(-(x - c) ** 2 / self.denominator))
+
+
+class Cross(Encoder):
+    """
+    Crosses an encoder with discrete signals (by default the action): a
+    separate copy of the encoder's block for every combination of their
+    values, so the weights can differ per action (and e.g. per phase).
+    """
+    def __init__(self, encoder, by=('action',)):
+        self.encoder = encoder
+        self.by = tuple(by)
+        self.signals = tuple(s for s in self.by if s != 'action') + tuple(encoder.signals)
+        self.blocks = 1
+        for signal in self.by:
+            self.blocks *= DISCRETE_SIZES[signal]
+        self.size = encoder.size * self.blocks
+
+    def encode(self, signals, indices, values, offset):
+        block = 0
+        for signal in self.by:
+            block = block * DISCRETE_SIZES[signal] + int(signals[signal])
+        self.encoder.encode(signals, indices, values, offset + block * self.encoder.size)
+
+
+class FeatureSpec:
+    """
+    A fixed layout of encoders. Feature indices of encoder i start at
+    self.offsets[i]; numFeatures is the total length of the vector.
+
+        spec = FeatureSpec([
+            Cross(Bias()),
+            Cross(TileCoding(['queue_ns', 'queue_ew'], [0, 0], [40, 40], [8, 8], numTilings=4),
+                  by=('action', 'phase')),
+            Cross(RBF('time_of_day', centers=np.linspace(0, 1, 6), width=0.1)),
+        ])
+        indices, values = spec.getSparseFeatures(state, 'SWITCH')
+    """
+    def __init__(self, encoders, actions=ACTIONS):
+        self.encoders = list(encoders)
+        self.actionIndex = {action: i for i, action in enumerate(actions)}
+        self.offsets = []
+        self.numFeatures = 0
+        for encoder in self.encoders:
+            self.offsets.append(self.numFeatures)
+            self.numFeatures += encoder.size
+        self.signals = []
+        for encoder in self.encoders:
+            for signal in encoder.signals:
+                if signal not in SIGNALS:
+                    raise ValueError(f"Unknown signal: {signal}")
+                if signal not in self.signals:
+                    self.signals.append(signal)
+
+    def getSparseFeatures(self, state, action):
+        """
+        Returns (indices, values) arrays of the active features. Indices
+        are unique and sorted by encoder.
+        """
+        signals = {name: SIGNALS[name](state) for name in self.signals}
+        signals['action'] = self.actionIndex[action]
+        indices = []
+        values = []
+        for encoder, offset in zip(self.encoders, self.offsets):
+            encoder.encode(signals, indices, values, offset)
+        return np.array(indices, dtype=np.int64), np.array(values, dtype=np.float64)
+
+
+def defaultTrafficSpec(maxCars=40, maxTicks=13, numTilings=4):
+    """
+    Action-crossed bias, queue lengths tiled per phase, time since the last
+    switch tiled per phase and an RBF encoding of the time of day.
+    """
+    return FeatureSpec([
+        Cross(Bias()),
+        Cross(TileCoding(['queue_ns', 'queue_ew'], [0, 0], [maxCars, maxCars], [8, 8], numTilings),
+              by=('action', 'phase')),
+        Cross(TileCoding(['ticks_since_last_switch', 'queue_diff'], [0, -maxCars], [maxTicks, maxCars],
+                         [maxTicks, 8], numTilings),
+              by=('action', 'phase')),
+        Cross(RBF('time_of_day', centers=[i / 6.0 for i in range(7)], width=1 / 12.0)),
+    ])
+
+
+class SpecFeatureExtractor(FeatureExtractor):
+    """
+    FeatureExtractor backed by a FeatureSpec. getFeatures() keeps the usual
+    util.Counter interface (keys are feature indices); agents that know
+    about numFeatures and getSparseFeatures() use the array fast path.
+    """
+    def __init__(self, spec=None):
+        self.spec = spec if spec is not None else defaultTrafficSpec()
+        self.numFeatures = self.spec.numFeatures
+
+    def getSparseFeatures(self, state, action):
+        return self.spec.getSparseFeatures(state, action)
+
+    def getFeatures(self, state, action):
+        indices, values = self.spec.getSparseFeatures(state, action)
+        features = util.Counter()
+        for index, value in zip(indices.tolist(), values.tolist()):
+            features[index] = value
+        return features
@@ -0,0 +1,142 @@
+import math
+import numpy as np
+from states import (TFState, TFStateEncoder, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH,
+                    PENALTY_THRESHOLD, PENALTY_AMOUNT, DEPARTURE_RATE,
+                    ARRIVAL_BASE, ARRIVAL_AMPLITUDE, ACTIONS, ACTION_INDEX)
+
+
+
+class TrafficMDP:
+    """
+    The TFState dynamics as an explicit MDP over the states of a
+    TFStateEncoder.
+
+    Transitions are stored as a sparse tensor with a fixed number K of
+    successors per (action, state):
+      nextStates[a, s, k] - index of the k-th successor
+      probs[a, s, k]      - its probability (rows sum to 1)
+      rewards[a, s]       - expected immediate reward
+      legal[a, s]         - whether the action is allowed in s
+
+    Successors come from the two possible arrival counts (the noise in
+    TFState.updateState rounds the sine rate down or up) times staying in
+    or advancing to the next time-of-day bin. Queues are capped at the
+    encoder's maxCars; rewards are computed before capping.
+    """
+    def __init__(self, encoder=None, reward_type='initial'):
+        self.encoder = encoder if encoder is not None else TFStateEncoder()
+        self.reward_type = reward_type
+        self.numStates = self.encoder.numStates
+        self.build()
+
+    def build(self):
+        encoder = self.encoder
+        phase, ns, ew, since, timeBin = encoder.decode(np.arange(self.numStates, dtype=np.int64))
+
+        # Time of day advances by one bin every ticksPerEpisode / timeBins ticks on average
+        advance = min(1.0, encoder.timeBins / float(encoder.ticksPerEpisode))
+        timeOutcomes = [(timeBin, 1.0 - advance), ((timeBin + 1) % encoder.timeBins, advance)]
+
+        # round(rate + U(-0.5, 0.5)) is floor(rate) + 1 with probability frac(rate)
+        rate = ARRIVAL_BASE + ARRIVAL_AMPLITUDE * np.sin(2 * math.pi * (timeBin + 0.5) / encoder.timeBins)
+        low = np.floor(rate)
+        frac = rate - low
+        arrivalOutcomes = [(np.maximum(low, 0).astype(np.int64), 1.0 - frac), (low.astype(np.int64) + 1, frac)]
+
+        numSuccessors = len(arrivalOutcomes) * len(timeOutcomes)
+        shape = (len(ACTIONS), self.numStates, numSuccessors)
+        self.nextStates = np.zeros(shape, dtype=np.int64)
+        self.probs = np.zeros(shape)
+        self.rewards = np.zeros((len(ACTIONS), self.numStates))
+        self.legal = np.zeros((len(ACTIONS), self.numStates), dtype=bool)
+
+        for a, action in enumerate(ACTIONS):
+            if action == 'SWITCH':
+                nextPhase = 1 - phase
+                nextSince = np.zeros_like(since)
+                penalty = np.where(since < PENALTY_THRESHOLD, PENALTY_AMOUNT, 0)
+                self.legal[a] = since >= MIN_TICKS_BEFORE_SWITCH
+            else:
+                nextPhase = phase
+                nextSince = np.minimum(since + 1, MAX_TICKS_BEFORE_SWITCH)
+                penalty = np.zeros_like(since)
+                self.legal[a] = since < MAX_TICKS_BEFORE_SWITCH
+
+            k = 0
+            for arrivals, arrivalProb in arrivalOutcomes:
+                nextNs = ns + 3 * arrivals // 5
+                nextEw = ew + arrivals - 3 * arrivals // 5
+                nextNs = np.where(nextPhase == 1, np.maximum(0, nextNs - DEPARTURE_RATE), nextNs)
+                nextEw = np.where(nextPhase == 0, np.maximum(0, nextEw - DEPARTURE_RATE), nextEw)
+                self.rewards[a] += arrivalProb * self.rewardOf(nextNs, nextEw, penalty)
+                nextNs = np.minimum(nextNs, encoder.maxCars)
+                nextEw = np.minimum(nextEw, encoder.maxCars)
+                for nextBin, timeProb in timeOutcomes:
+                    self.nextStates[a, :, k] = encoder.encodeValues(nextPhase, nextNs, nextEw, nextSince, nextBin)
+                    self.probs[a, :, k] = arrivalProb * timeProb
+                    k += 1
+
+    def rewardOf(self, ns, ew, penalty):
+        """
+        Vectorized TFState.getReward: the reward methods only do arithmetic
+        on the queue and penalty attributes, so they run unchanged on arrays.
+        """
+        state = TFState(None, None, ns, ew, self.reward_type)
+        state.last_action_penalty = penalty
+        return state.getReward()
+
+    def computeQValues(self, values, gamma):
+        """
+        Q[a, s] = R[a, s] + gamma * sum_k P[a, s, k] * V[next[a, s, k]],
+        with -inf for illegal actions.
+        """
+        qValues = self.rewards + gamma * (self.probs * values[self.nextStates]).sum(axis=-1)
+        qValues[~self.legal] = -np.inf
+        return qValues
+
+
+def valueIteration(mdp, gamma, tolerance=1e-6, maxIterations=10000):
+    """
+    Synchronous value iteration until the largest change of V is below
+    tolerance. Returns (values, qValues, iterations).
+    """
+    values = np.zeros(mdp.numStates)
+    for iteration in range(1, maxIterations + 1):
+        qValues = mdp.computeQValues(values, gamma)
+        newValues = qValues.max(axis=0)
+        delta = np.abs(newValues - values).max()
+        values = newValues
+        if delta < tolerance:
+            break
+    return values, mdp.computeQValues(values, gamma), iteration
+
+
+def policyIteration(mdp, gamma, tolerance=1e-6, maxIterations=1000, evaluationSweeps=1000):
+    """
+    Policy iteration with iterative policy evaluation (each evaluation
+    stops after evaluationSweeps sweeps or when V changes less than
+    tolerance). Returns (values, qValues, policy, iterations) where policy
+    holds action indices.
+    """
+    states = np.arange(mdp.numStates)
+    values = np.zeros(mdp.numStates)
+    policy = np.argmax(mdp.legal, axis=0)
+    for iteration in range(1, maxIterations + 1):
+        nextStates = mdp.nextStates[policy, states]
+        probs = mdp.probs[policy, states]
+        rewards = mdp.rewards[policy, states]
+        for _ in range(evaluationSweeps):
+            newValues = rewards + gamma * (probs * values[nextStates]).sum(axis=-1)
+            delta = np.abs(newValues - values).max()
+            values = newValues
+            if delta < tolerance:
+                break
+        qValues = mdp.computeQValues(values, gamma)
+        newPolicy = np.argmax(qValues, axis=0)
+        # Keep the current action on ties so the loop terminates
+        stable = qValues[policy, states] >= qValues[newPolicy, states] - 1e-10
+        newPolicy = np.where(stable, policy, newPolicy)
+        if np.array_equal(newPolicy, policy):
+            break
+        policy = newPolicy
+    return values, qValues, policy, iteration
@@ -0,0 +1,254 @@
+"""
+Offline LSTD-Q and fitted-Q training of TrafficApproximateQAgent from
+transition logs: CSV files with the columns in COLUMNS (one row per
+transition, duration > 1 for macro steps) or .npz archives with one
+array per column.
+"""
+
+import csv
+import random
+import numpy as np
+from states import TFState, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH, ACTIONS
+
+COLUMNS = ('light_ns', 'ns', 'ew', 'tick', 'since', 'action', 'reward',
+           'next_light_ns', 'next_ns', 'next_ew', 'next_tick', 'next_since', 'duration')
+
+
+class TransitionWriter:
+    """
+    Appends transitions to a CSV transition log.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def record(self, state, action, nextState, reward, duration=1):
+        self.writer.writerow([
+            1 if state.light_color_ns == 'GREEN' else 0, state.num_cars_waiting_ns, state.num_cars_waiting_ew,
+            state.tick, state.ticks_since_last_switch, ACTIONS.index(action), reward,
+            1 if nextState.light_color_ns == 'GREEN' else 0, nextState.num_cars_waiting_ns,
+            nextState.num_cars_waiting_ew, nextState.tick, nextState.ticks_since_last_switch, duration])
+
+    def close(self):
+        self.file.close()
+
+
+def collectTransitions(agent, path, episodes=10, steps_per_episode=4320, reward_type='initial', learn=False):
+    """
+    Runs `agent` (without learning unless learn is True) and logs every
+    transition to a CSV file at path.
+    """
+    writer = TransitionWriter(path)
+    try:
+        for _ in range(episodes):
+            state = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), reward_type)
+            for _ in range(steps_per_episode):
+                action = agent.getAction(state)
+                prev_state = state.copy()
+                state.updateState(action)
+                reward = state.getReward()
+                writer.record(prev_state, action, state, reward)
+                if learn:
+                    agent.observeTransition(prev_state, action, state, reward)
+    finally:
+        writer.close()
+
+
+def iterChunks(path, chunkSize=4096):
+    """
+    Yields dicts from column name to a NumPy array of at most chunkSize
+    transitions.
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as archive:
+            data = {column: archive[column] for column in COLUMNS if column in archive}
+        size = len(data['reward'])
+        for start in range(0, size, chunkSize):
+            chunk = {column: values[start:start + chunkSize] for column, values in data.items()}
+            chunk.setdefault('duration', np.ones(len(chunk['reward']), dtype=np.int64))
+            yield chunk
+        return
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == chunkSize:
+                yield toChunk(header, rows)
+                rows = []
+        if rows:
+            yield toChunk(header, rows)
+
+
+def toChunk(header, rows):
+    table = np.array(rows, dtype=np.float64)
+    chunk = {column: table[:, i] for i, column in enumerate(header)}
+    chunk.setdefault('duration', np.ones(len(rows)))
+    return chunk
+
+
+def toStates(light_ns, ns, ew, tick, since, reward_type, ticks_per_episode):
+    states = []
+    for green, n, e, t, s in zip(light_ns.tolist(), ns.tolist(), ew.tolist(), tick.tolist(), since.tolist()):
+        state = TFState('GREEN' if green else 'RED', 'RED' if green else 'GREEN', int(n), int(e),
+                        reward_type, ticks_per_episode)
+        state.tick = int(t)
+        state.ticks_since_last_switch = int(s)
+        states.append(state)
+    return states
+
+
+class OfflineTrainer:
+    """
+    Fits the weights of a TrafficApproximateQAgent to a transition log.
+
+    method     - 'lstd': LSTD-Q policy iteration (LSPI). Each sweep solves
+                 A w = b with A = sum phi(s,a) (phi(s,a) - gamma^d phi(s', pi(s')))^T
+                 and b = sum phi(s,a) r for the greedy policy pi of the
+                 previous w.
+                 'fqi': fitted Q-iteration. Each sweep regresses
+                 phi(s,a) w onto r + gamma^d max_a' Q(s', a') of the
+                 previous w.
+    sweeps     - maximum number of passes over the data
+    ridge      - L2 regularization added to the normal equations
+    tolerance  - stop when no weight changes by more than this
+    cache      - keep the feature matrices of all chunks in memory
+                 instead of re-reading and re-extracting them every sweep
+    """
+    def __init__(self, agent, path, method='lstd', sweeps=20, chunkSize=4096, ridge=1e-3, tolerance=1e-4,
+                 cache=False, reward_type='initial', ticks_per_episode=4320):
+        if method not in ('lstd', 'fqi'):
+            raise ValueError(f"Unknown method: {method}")
+        self.agent = agent
+        self.path = path
+        self.method = method
+        self.sweeps = sweeps
+        self.chunkSize = chunkSize
+        self.ridge = ridge
+        self.tolerance = tolerance
+        self.cache = [] if cache else None
+        self.reward_type = reward_type
+        self.ticks_per_episode = ticks_per_episode
+        self.numFeatures = agent.fixFeatureVocabulary()
+        self.history = []
+
+    def featureMatrix(self, states, actions):
+        """
+        phi(state, action) for every row as a padded sparse matrix: an
+        (indices, values) pair of (len(states), k) arrays, where k is the
+        largest number of active features and padding has value 0.
+        """
+        rows = [self.agent.getFeatureVector(state, action) for state, action in zip(states, actions)]
+        width = max(len(indices) for indices, _ in rows)
+        indices = np.zeros((len(rows), width), dtype=np.int64)
+        values = np.zeros((len(rows), width))
+        for row, (rowIndices, rowValues) in enumerate(rows):
+            valid = rowIndices >= 0
+            indices[row, :valid.sum()] = rowIndices[valid]
+            values[row, :valid.sum()] = rowValues[valid]
+        return indices, values
+
+    def dot(self, matrix, weights):
+        """
+        Row-wise phi . weights of a padded sparse matrix.
+        """
+        indices, values = matrix
+        return (values * weights[indices]).sum(axis=1)
+
+    def transposeDot(self, matrix, vector):
+        """
+        phi^T vector, a dense numFeatures vector.
+        """
+        indices, values = matrix
+        return np.bincount(indices.ravel(), weights=(values * vector[:, None]).ravel(), minlength=self.numFeatures)
+
+    def pad(self, matrix, width):
+        """
+        A padded sparse matrix widened to width columns.
+        """
+        indices, values = matrix
+        extra = width - indices.shape[1]
+        return np.pad(indices, ((0, 0), (0, extra))), np.pad(values, ((0, 0), (0, extra)))
+
+    def addOuter(self, A, left, right):
+        """
+        Adds left^T right for two padded sparse matrices with the same rows
+        to A in place, touching only the (row, column) index pairs of
+        active features.
+        """
+        leftIndices, leftValues = left
+        rightIndices, rightValues = right
+        rows = np.broadcast_to(leftIndices[:, :, None], (len(leftIndices), leftIndices.shape[1], rightIndices.shape[1]))
+        columns = np.broadcast_to(rightIndices[:, None, :], rows.shape)
+        np.add.at(A, (rows.ravel(), columns.ravel()), (leftValues[:, :, None] * rightValues[:, None, :]).ravel())
+
+    def iterFeatureChunks(self):
+        """
+        Yields (phi, reward, discount exponents, next phi per action, legal
+        mask of next actions) for every chunk of the log.
+        """
+        if self.cache:
+            yield from self.cache
+            return
+        for chunk in iterChunks(self.path, self.chunkSize):
+            states = toStates(chunk['light_ns'], chunk['ns'], chunk['ew'], chunk['tick'], chunk['since'],
+                              self.reward_type, self.ticks_per_episode)
+            nextStates = toStates(chunk['next_light_ns'], chunk['next_ns'], chunk['next_ew'], chunk['next_tick'],
+                                  chunk['next_since'], self.reward_type, self.ticks_per_episode)
+            actions = [ACTIONS[int(a)] for a in chunk['action'].tolist()]
+            phi = self.featureMatrix(states, actions)
+            nextPhi = [self.featureMatrix(nextStates, [action] * len(nextStates)) for action in ACTIONS]
+            # Same width for every action, so the greedy one can be picked per row
+            width = max(indices.shape[1] for indices, _ in nextPhi)
+            nextPhi = [self.pad(matrix, width) for matrix in nextPhi]
+            nextSince = chunk['next_since']
+            legal = np.stack([nextSince >= MIN_TICKS_BEFORE_SWITCH, nextSince < MAX_TICKS_BEFORE_SWITCH])
+            features = (phi, chunk['reward'], chunk['duration'], nextPhi, legal)
+            if self.cache is not None:
+                self.cache.append(features)
+            yield features
+
+    def fit(self):
+        """
+        Runs the sweeps, writes the weights into the agent and returns them.
+        """
+        weights = self.agent.weights.values[:self.numFeatures].copy()
+        gamma = self.agent.discount
+        for sweep in range(self.sweeps):
+            A = self.ridge * np.eye(self.numFeatures)
+            b = np.zeros(self.numFeatures)
+            for phi, reward, duration, nextPhi, legal in self.iterFeatureChunks():
+                nextQ = np.where(legal, np.stack([self.dot(matrix, weights) for matrix in nextPhi]), -np.inf)
+                discount = gamma ** duration
+                if self.method == 'lstd':
+                    # phi(s, a) - gamma^d phi(s', pi(s')) as one padded matrix
+                    greedy = np.argmax(nextQ, axis=0)[:, None]
+                    nextIndices = np.where(greedy == 0, nextPhi[0][0], nextPhi[1][0])
+                    nextValues = np.where(greedy == 0, nextPhi[0][1], nextPhi[1][1])
+                    difference = (np.concatenate([phi[0], nextIndices], axis=1),
+                                  np.concatenate([phi[1], -discount[:, None] * nextValues], axis=1))
+                    self.addOuter(A, phi, difference)
+                    b += self.transposeDot(phi, reward)
+                else:
+                    self.addOuter(A, phi, phi)
+                    b += self.transposeDot(phi, reward + discount * nextQ.max(axis=0))
+            newWeights = np.linalg.solve(A, b)
+            change = np.abs(newWeights - weights).max()
+            weights = newWeights
+            self.history.append(change)
+            if change < self.tolerance:
+                break
+        self.agent.weights.values[:self.numFeatures] = weights
+        return weights
+
+
+if __name__ == '__main__':
+    from qlearning_agents import QLearningAgent, TrafficApproximateQAgent
+    # Log an exploratory controller, then fit a policy from the log alone
+    collectTransitions(QLearningAgent(epsilon=0.3, alpha=0.2, gamma=0.8), 'transitions.csv', episodes=5,
+                       steps_per_episode=2000, learn=True)
+    agent = TrafficApproximateQAgent(alpha=0.0, epsilon=0.0, gamma=0.8)
+    trainer = OfflineTrainer(agent, 'transitions.csv', method='lstd')
+    print(trainer.fit(), trainer.history)
@@ -0,0 +1,96 @@
+import numpy as np
+import util
+
+
+class Optimizer:
+    """
+    Applies a gradient step to the weights of an approximate agent.
+
+    weights  - NumPy array of weights (e.g. util.SparseVector.values)
+    indices  - unique indices of the active features
+    gradient - TD error * feature value for each of those indices
+    alpha    - current learning rate
+
+    Optimizer state is kept in arrays that grow with the weights, so
+    vocabularies can keep adding features during training.
+    """
+    def step(self, weights, indices, gradient, alpha):
+        util.raiseNotDefined()
+
+    def resized(self, state, weights):
+        if len(state) < len(weights):
+            grown = np.zeros(len(weights))
+            grown[:len(state)] = state
+            return grown
+        return state
+
+
+class SGD(Optimizer):
+    """
+    Plain semi-gradient step, the original TrafficApproximateQAgent update.
+    """
+    def step(self, weights, indices, gradient, alpha):
+        weights[indices] += alpha * gradient
+
+
+class RMSProp(Optimizer):
+    """
+    Divides each feature's step by a running RMS of its gradients, so
+    features measured in cars (large) and indicators (0/1) move at
+    comparable speeds.
+    """
+    def __init__(self, decay=0.99, eps=1e-8):
+        self.decay = decay
+        self.eps = eps
+        self.meanSquare = np.zeros(0)
+
+    def step(self, weights, indices, gradient, alpha):
+        self.meanSquare = self.resized(self.meanSquare, weights)
+        ms = self.decay * self.meanSquare[indices] + (1 - self.decay) * gradient * gradient
+        self.meanSquare[indices] = ms
+        weights[indices] += alpha * gradient / (np.sqrt(ms) + self.eps)
+
+
+class Adam(Optimizer):
+    """
+    Adam with bias-corrected first and second moment estimates. Moments
+    of inactive features are not decayed (lazy Adam).
+    """
+    def __init__(self, beta1=0.9, beta2=0.999, eps=1e-8):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+        self.t = 0
+        self.firstMoment = np.zeros(0)
+        self.secondMoment = np.zeros(0)
+
+    def step(self, weights, indices, gradient, alpha):
+        self.firstMoment = self.resized(self.firstMoment, weights)
+        self.secondMoment = self.resized(self.secondMoment, weights)
+        self.t += 1
+        m = self.beta1 * self.firstMoment[indices] + (1 - self.beta1) * gradient
+        v = self.beta2 * self.secondMoment[indices] + (1 - self.beta2) * gradient * gradient
+        self.firstMoment[indices] = m
+        self.secondMoment[indices] = v
+        mHat = m / (1 - self.beta1 ** self.t)
+        vHat = v / (1 - self.beta2 ** self.t)
+        weights[indices] += alpha * mHat / (np.sqrt(vHat) + self.eps)
+
+
+OPTIMIZERS = {
+    'sgd': SGD,
+    'rmsprop': RMSProp,
+    'adam': Adam,
+}
+
+
+def getOptimizer(optimizer):
+    """
+    Returns an Optimizer instance from a name ('sgd', 'rmsprop', 'adam')
+    or passes an Optimizer instance through.
+    """
+    if isinstance(optimizer, Optimizer):
+        return optimizer
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer: {optimizer}")
+    return OPTIMIZERS[optimizer]()
@@ -0,0 +1,181 @@
+"""
+Asynchronous (Hogwild-style) parallel Q-learning: worker processes run
+their own episodes and update one Q-table or weight vector held in
+shared memory, without locks.
+"""
+
+import multiprocessing as mp
+import queue
+import random
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from states import TFState, TFStateEncoder
+from qlearning_agents import EncodedQAgent, TrafficApproximateQAgent
+from traffic_lights import run_episode
+
+
+def makeAgent(config, values):
+    """
+    Builds a worker's agent on top of the shared array `values`.
+    """
+    if config['mode'] == 'tabular':
+        return EncodedQAgent(values, config['encoder'], **config['agentArgs'])
+    agent = TrafficApproximateQAgent(extractor=config['extractor'], **config['agentArgs'])
+    agent.fixFeatureVocabulary()
+    agent.weights.values = values
+    return agent
+
+
+def tableShape(config):
+    if config['mode'] == 'tabular':
+        return (config['encoder'].numStates, 2)
+    agent = TrafficApproximateQAgent(extractor=config['extractor'], **config['agentArgs'])
+    return (agent.fixFeatureVocabulary(),)
+
+
+def runWorker(workerId, config, name, shape, curves):
+    """
+    Ends with (workerId, None, error, None) on curves, error being None
+    on success and a description of the exception otherwise.
+    """
+    random.seed(config['seed'] + workerId)
+    memory = shared_memory.SharedMemory(name=name)
+    error = None
+    try:
+        values = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+        agent = makeAgent(config, values)
+        started = time.perf_counter()
+        for episode in range(config['episodes']):
+            state = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), config['reward_type'])
+            agent.startEpisode()
+            total_reward, _ = run_episode(agent, state, config['steps_per_episode'], {'ns': [], 'ew': []})
+            agent.stopEpisode()
+            curves.put((workerId, episode, total_reward, time.perf_counter() - started))
+        # Drop every view on the buffer before closing it
+        del agent, values
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        curves.put((workerId, None, error, None))
+        try:
+            memory.close()
+        except BufferError:
+            # The traceback still holds views on the buffer; it is
+            # released when the process exits
+            pass
+
+
+class HogwildTrainer:
+    """
+    Trains one shared Q-table or weight vector with numWorkers processes.
+
+    mode              - 'tabular' (a (numStates, 2) table through
+                        EncodedQAgent) or 'approximate' (the weights of a
+                        TrafficApproximateQAgent, with the feature
+                        vocabulary fixed so all workers share indices)
+    episodes          - episodes per worker
+    encoder           - TFStateEncoder for the tabular table
+    extractor         - feature extractor for the approximate agent. Only
+                        the weights are shared: a NormalizedFeatureExtractor
+                        keeps its running statistics per worker, so workers
+                        scale features by their own estimates
+    agentArgs         - passed on to the worker agents (alpha, epsilon, ...).
+                        Visit counts are not shared: with a visit-count
+                        alpha schedule each worker counts its own visits
+
+    Whether more workers reach a given reward sooner depends on the
+    cores available and on how often workers write the same entries;
+    the __main__ block compares one worker with one per core.
+
+    After train(), self.curves maps worker id to a list of
+    (episode, total reward, seconds since the worker started).
+    """
+    def __init__(self, mode='tabular', numWorkers=None, episodes=10, steps_per_episode=1000, reward_type='initial',
+                 encoder=None, extractor=None, seed=0, **agentArgs):
+        if mode not in ('tabular', 'approximate'):
+            raise ValueError(f"Unknown mode: {mode}")
+        self.numWorkers = numWorkers or mp.cpu_count()
+        self.config = {
+            'mode': mode,
+            'episodes': episodes,
+            'steps_per_episode': steps_per_episode,
+            'reward_type': reward_type,
+            'encoder': encoder if encoder is not None else TFStateEncoder(),
+            'extractor': extractor,
+            'seed': seed,
+            'agentArgs': agentArgs,
+        }
+        self.values = None
+        self.curves = {}
+        self.elapsed = 0.0
+
+    def train(self):
+        """
+        Runs all workers to completion and returns an agent over a private
+        copy of the learned table. Raises RuntimeError if a worker failed.
+        """
+        shape = tableShape(self.config)
+        memory = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * 8))
+        try:
+            values = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+            values[:] = 0.0
+            curves = mp.Queue()
+            workers = [mp.Process(target=runWorker, args=(i, self.config, memory.name, shape, curves))
+                       for i in range(self.numWorkers)]
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            self.curves = {i: [] for i in range(self.numWorkers)}
+            finished = 0
+            errors = []
+            while finished < self.numWorkers:
+                try:
+                    workerId, episode, total_reward, elapsed = curves.get(timeout=0.5)
+                except queue.Empty:
+                    # Workers killed outright never send their sentinel
+                    if not any(worker.is_alive() for worker in workers):
+                        break
+                    continue
+                if episode is None:
+                    finished += 1
+                    if total_reward is not None:
+                        errors.append(f"worker {workerId}: {total_reward}")
+                else:
+                    self.curves[workerId].append((episode, total_reward, elapsed))
+            for worker in workers:
+                worker.join()
+            self.elapsed = time.perf_counter() - started
+            failed = [(i, worker.exitcode) for i, worker in enumerate(workers) if worker.exitcode != 0]
+            if errors or failed:
+                del values
+                raise RuntimeError(f"Workers failed (exit codes {failed}): {'; '.join(errors)}")
+            self.values = values.copy()
+            del values
+        finally:
+            memory.close()
+            memory.unlink()
+        return self.getAgent()
+
+    def getAgent(self):
+        return makeAgent(self.config, self.values)
+
+    def learningCurve(self):
+        """
+        All episodes of all workers as (seconds since start, total reward),
+        in completion order.
+        """
+        points = [(elapsed, total_reward) for curve in self.curves.values() for _, total_reward, elapsed in curve]
+        return sorted(points)
+
+
+if __name__ == '__main__':
+    # Same total number of episodes with 1 and with all cores
+    total_episodes = 8 * mp.cpu_count()
+    for workers in (1, mp.cpu_count()):
+        trainer = HogwildTrainer('tabular', numWorkers=workers, episodes=total_episodes // workers,
+                                 steps_per_episode=2000, alpha=0.2, epsilon=0.1, gamma=0.8)
+        trainer.train()
+        rewards = [r for _, r in trainer.learningCurve()]
+        print(f"{workers} worker(s): {trainer.elapsed:.1f}s, mean reward of last episodes {np.mean(rewards[-workers:]):.0f}")
@@ -0,0 +1,249 @@
+"""
+Table-driven multi-phase signal engine: SignalPlan compiles a cycle of
+phases into integer tables, and PhaseEngine steps any number of
+intersections at once by indexing them with NumPy.
+"""
+
+import math
+import numpy as np
+from states import (MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH, PENALTY_THRESHOLD, PENALTY_AMOUNT,
+                    DEPARTURE_RATE, ARRIVAL_BASE, ARRIVAL_AMPLITUDE, ARRIVAL_NOISE, ACTIONS)
+
+SWITCH, STAY = 0, 1
+COLORS = ('RED', 'YELLOW', 'GREEN')
+# Interval kinds of a signal state
+GREEN, YELLOW, ALL_RED = 0, 1, 2
+
+# name, departures per movement, minGreen, maxGreen, yellow, allRed
+TWO_PHASE_TABLE = [
+    ('NS', {'NS': DEPARTURE_RATE}, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH, 0, 0),
+    ('EW', {'EW': DEPARTURE_RATE}, MIN_TICKS_BEFORE_SWITCH, MAX_TICKS_BEFORE_SWITCH, 0, 0),
+]
+FOUR_PHASE_TABLE = [
+    ('NS_LEFT', {'NS_LEFT': 2}, 2, 6, 2, 1),
+    ('NS', {'NS': DEPARTURE_RATE}, 4, 20, 3, 1),
+    ('EW_LEFT', {'EW_LEFT': 2}, 2, 6, 2, 1),
+    ('EW', {'EW': DEPARTURE_RATE}, 4, 20, 3, 1),
+]
+
+
+class Phase:
+    """
+    One phase of a signal plan.
+
+    departures - dict from movement to cars leaving per green tick
+    """
+    def __init__(self, name, departures, minGreen=MIN_TICKS_BEFORE_SWITCH, maxGreen=MAX_TICKS_BEFORE_SWITCH,
+                 yellow=0, allRed=0):
+        if not 0 <= minGreen <= maxGreen:
+            raise ValueError(f"Phase {name}: need 0 <= minGreen <= maxGreen")
+        self.name = name
+        self.departures = dict(departures)
+        self.minGreen = int(minGreen)
+        self.maxGreen = int(maxGreen)
+        self.yellow = int(yellow)
+        self.allRed = int(allRed)
+
+
+class SignalPlan:
+    """
+    A cycle of Phases. Every phase gives green to some movements, lasts
+    between minGreen and maxGreen ticks and is followed by `yellow` ticks
+    of yellow and `allRed` ticks of all-red clearance. 'SWITCH' ends the
+    current green, 'STAY' keeps it; only 'STAY' is legal during clearance.
+
+    The plan is compiled into integer tables over signal states (phase,
+    interval, ticks in interval), so a tick is a few table lookups:
+        nextSignal[s, a]   signal state after action a
+        legal[s, a]        whether a is legal in s
+        penalty[s, a]      switching penalty of a in s
+        departures[s, m]   cars of movement m leaving per tick
+        colors[s, m]       index into COLORS of movement m
+
+    movements       - movement names (default: in order of appearance)
+    arrivalWeights  - dict from movement to an integer share of the
+                      arrivals (default: equal shares)
+    """
+    def __init__(self, phases, movements=None, arrivalWeights=None, penaltyThreshold=PENALTY_THRESHOLD,
+                 penaltyAmount=PENALTY_AMOUNT):
+        if not phases:
+            raise ValueError("A signal plan needs at least one phase")
+        self.phases = list(phases)
+        if movements is None:
+            movements = []
+            for phase in self.phases:
+                movements.extend(m for m in phase.departures if m not in movements)
+        self.movements = tuple(movements)
+        weights = arrivalWeights or {m: 1 for m in self.movements}
+        # Arrivals n are split as n * cumulative // total, so integer
+        # weights give an exact integer split (3:2 is TFState's 3n//5)
+        self.arrivalCumulative = np.cumsum([0] + [int(weights.get(m, 0)) for m in self.movements])
+        self.penaltyThreshold = penaltyThreshold
+        self.penaltyAmount = penaltyAmount
+        self.compile()
+
+    def compile(self):
+        # Enumerate signal states, phase by phase
+        self.states = []
+        self.greenStart = []
+        self.clearanceStart = []
+        for p, phase in enumerate(self.phases):
+            self.greenStart.append(len(self.states))
+            self.states.extend((p, GREEN, e) for e in range(phase.maxGreen + 1))
+            self.clearanceStart.append(len(self.states))
+            self.states.extend((p, YELLOW, e) for e in range(phase.yellow))
+            self.states.extend((p, ALL_RED, e) for e in range(phase.allRed))
+        index = {state: s for s, state in enumerate(self.states)}
+        numStates = self.numSignalStates = len(self.states)
+        numMovements = len(self.movements)
+
+        self.nextSignal = np.zeros((numStates, len(ACTIONS)), dtype=np.int32)
+        self.legal = np.zeros((numStates, len(ACTIONS)), dtype=bool)
+        self.penalty = np.zeros((numStates, len(ACTIONS)), dtype=np.int64)
+        self.departures = np.zeros((numStates, numMovements), dtype=np.int64)
+        self.colors = np.zeros((numStates, numMovements), dtype=np.int8)
+        self.phaseOf = np.array([p for p, _, _ in self.states], dtype=np.int32)
+        self.kindOf = np.array([kind for _, kind, _ in self.states], dtype=np.int8)
+        self.elapsedOf = np.array([e for _, _, e in self.states], dtype=np.int32)
+        movementIndex = {m: i for i, m in enumerate(self.movements)}
+
+        for s, (p, kind, e) in enumerate(self.states):
+            phase = self.phases[p]
+            nextGreen = self.greenStart[(p + 1) % len(self.phases)]
+            served = [movementIndex[m] for m in phase.departures]
+            if kind == GREEN:
+                self.nextSignal[s, STAY] = index[(p, GREEN, min(e + 1, phase.maxGreen))]
+                self.nextSignal[s, SWITCH] = self.clearanceStart[p] if phase.yellow + phase.allRed else nextGreen
+                self.legal[s, SWITCH] = e >= phase.minGreen
+                self.legal[s, STAY] = e < phase.maxGreen
+                self.penalty[s, SWITCH] = self.penaltyAmount if e < self.penaltyThreshold else 0
+                for m, rate in phase.departures.items():
+                    self.departures[s, movementIndex[m]] = rate
+                self.colors[s, served] = COLORS.index('GREEN')
+            else:
+                length = phase.yellow if kind == YELLOW else phase.allRed
+                if e + 1 < length:
+                    following = index[(p, kind, e + 1)]
+                elif kind == YELLOW and phase.allRed:
+                    following = index[(p, ALL_RED, 0)]
+                else:
+                    following = nextGreen
+                # Clearance runs on its own: SWITCH is illegal and ignored
+                self.nextSignal[s] = following
+                self.legal[s, STAY] = True
+                if kind == YELLOW:
+                    self.colors[s, served] = COLORS.index('YELLOW')
+
+    def describe(self, signal):
+        """
+        (phase name, interval kind, ticks in interval) of a signal state.
+        """
+        p, kind, e = self.states[signal]
+        return self.phases[p].name, ('GREEN', 'YELLOW', 'ALL_RED')[kind], e
+
+
+def makePlan(table, **args):
+    """
+    SignalPlan from rows of (name, departures, minGreen, maxGreen, yellow,
+    allRed), e.g. TWO_PHASE_TABLE or FOUR_PHASE_TABLE.
+    """
+    return SignalPlan([Phase(*row) for row in table], **args)
+
+
+def twoPhasePlan():
+    """
+    The TFState intersection: NS/EW without clearance, arrivals split 3:2.
+    """
+    return makePlan(TWO_PHASE_TABLE, arrivalWeights={'NS': 3, 'EW': 2})
+
+
+def fourPhasePlan():
+    """
+    Protected left turns before each through phase, with yellow and
+    all-red clearance.
+    """
+    return makePlan(FOUR_PHASE_TABLE, arrivalWeights={'NS': 4, 'NS_LEFT': 2, 'EW': 3, 'EW_LEFT': 1})
+
+
+class PhaseEngine:
+    """
+    Simulates numIntersections independent intersections running the same
+    SignalPlan. State is kept in arrays: signal (N,), queues (N, movements),
+    tick (N,) and the penalty of the last action (N,).
+
+    Arrivals follow TFState.sampleArrivals per intersection and are split
+    between movements by the plan's arrival weights.
+    """
+    def __init__(self, plan, numIntersections=1, reward_type='initial', ticks_per_episode=4320, seed=None):
+        self.plan = plan
+        self.numIntersections = int(numIntersections)
+        self.reward_type = reward_type
+        self.ticks_per_episode = ticks_per_episode
+        self.random = np.random.default_rng(seed)
+        self.reset()
+
+    def reset(self, queues=None, phase=0):
+        n = self.numIntersections
+        self.signal = np.full(n, self.plan.greenStart[phase], dtype=np.int32)
+        self.queues = np.zeros((n, len(self.plan.movements)), dtype=np.int64)
+        if queues is not None:
+            self.queues[:] = queues
+        self.tick = np.zeros(n, dtype=np.int64)
+        self.lastPenalty = np.zeros(n, dtype=np.int64)
+
+    def legalMask(self):
+        """
+        Boolean (N, 2) mask of legal actions in ACTIONS order.
+        """
+        return self.plan.legal[self.signal]
+
+    def sampleArrivals(self):
+        rate = ARRIVAL_BASE + ARRIVAL_AMPLITUDE * np.sin(2 * math.pi * self.tick / self.ticks_per_episode)
+        noise = self.random.uniform(-ARRIVAL_NOISE, ARRIVAL_NOISE, self.numIntersections)
+        return np.maximum(0, np.round(rate + noise)).astype(np.int64)
+
+    def splitArrivals(self, arrivals):
+        cumulative = self.plan.arrivalCumulative
+        shares = arrivals[:, None] * cumulative[None, :] // cumulative[-1]
+        return np.diff(shares, axis=1)
+
+    def step(self, actions, arrivals=None):
+        """
+        Advances every intersection by one tick. actions holds one index
+        into ACTIONS per intersection; arrivals (total new cars per
+        intersection) are sampled when not given. Returns the rewards.
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        self.lastPenalty = self.plan.penalty[self.signal, actions]
+        self.signal = self.plan.nextSignal[self.signal, actions]
+        self.tick += 1
+        if arrivals is None:
+            arrivals = self.sampleArrivals()
+        self.queues += self.splitArrivals(np.asarray(arrivals, dtype=np.int64))
+        np.maximum(self.queues - self.plan.departures[self.signal], 0, out=self.queues)
+        return self.getRewards()
+
+    def getRewards(self):
+        """
+        The TFState reward types, generalized to any number of movements
+        ('balanced' uses the largest minus the smallest queue).
+        """
+        total = self.queues.sum(axis=1)
+        if self.reward_type == 'initial':
+            return -total
+        elif self.reward_type == 'squared':
+            return -(self.queues ** 2).sum(axis=1)
+        elif self.reward_type == 'balanced':
+            imbalance = self.queues.max(axis=1) - self.queues.min(axis=1)
+            return -(total + 0.5 * imbalance ** 2)
+        elif self.reward_type == 'penalty':
+            return -(total + self.lastPenalty)
+        else:
+            raise ValueError(f"Unknown reward type: {self.reward_type}")
+
+    def getColors(self, intersection=0):
+        """
+        Dict from movement to 'RED', 'YELLOW' or 'GREEN'.
+        """
+        codes = self.plan.colors[self.signal[intersection]]
+        return {m: COLORS[c] for m, c in zip(self.plan.movements, codes.tolist())}
@@ -0,0 +1,124 @@
+"""
+Model-based planning on top of tabular Q-learning (Dyna-Q with
+prioritized sweeping).
+"""
+
+import heapq
+import itertools
+import time
+import numpy as np
+from states import TFStateEncoder, ACTIONS, ACTION_INDEX
+from qlearning_agents import QLearningAgent
+
+
+class DynaQAgent(QLearningAgent):
+    """
+    Q-Learning with prioritized sweeping. Every real transition is also
+    recorded in a model, (state, action) -> its last (state, next state,
+    reward, duration), with an index of the pairs leading to each state.
+    When a state's value changes its predecessors are queued by the size
+    of their TD error and replayed from the model, largest first.
+
+    planningSteps - planning updates per real transition (0 disables planning)
+    planningTime  - optional time budget in seconds for planning per tick
+    theta         - TD errors up to this magnitude are not queued
+    encoder       - states.TFStateEncoder (a default one if None):
+                    Q-values, visit counts, model and predecessors are
+                    kept per encoded state, so states visited at
+                    different ticks share them and the model holds at
+                    most two entries per encoded state. Full TFStates
+                    include the tick and never repeat, so a model keyed
+                    by them would grow without bound and have little to
+                    sweep.
+    """
+
+    def __init__(self, planningSteps=10, planningTime=None, theta=1e-4, encoder=None, **args):
+        QLearningAgent.__init__(self, **args)
+        self.planningSteps = planningSteps
+        self.planningTime = planningTime
+        self.theta = theta
+        self.encoder = encoder if encoder is not None else TFStateEncoder()
+        self.table = np.zeros((self.encoder.numStates, len(ACTIONS)))
+        self.visitCounts = np.zeros(self.table.shape, dtype=np.int64)
+        self.model = {}
+        self.predecessors = {}
+        self.queue = []
+        self.queued = {}
+        self.counter = itertools.count()
+        self.planningUpdates = 0
+
+    def stateKey(self, state):
+        return self.encoder.encode(state)
+
+    def getVisitCount(self, state, action):
+        return int(self.visitCounts[self.encoder.encode(state), ACTION_INDEX[action]])
+
+    def getQValue(self, state, action):
+        return float(self.table[self.encoder.encode(state), ACTION_INDEX[action]])
+
+    def setQValue(self, state, action, value):
+        self.table[self.encoder.encode(state), ACTION_INDEX[action]] = value
+
+    def tdError(self, state, action, nextState, reward, duration):
+        sample = reward + self.discount ** duration * self.computeValueFromQValues(nextState)
+        return sample - self.getQValue(state, action)
+
+    def learn(self, state, action, nextState, reward, duration, alpha):
+        self.setQValue(state, action, self.getQValue(state, action) +
+                       alpha * self.tdError(state, action, nextState, reward, duration))
+
+    def update(self, state, action, nextState, reward, duration=1):
+        self.learn(state, action, nextState, reward, duration, self.getAlpha(state, action))
+        self.visitCounts[self.encoder.encode(state), ACTION_INDEX[action]] += 1
+        # Callers keep stepping the states they pass in, so the model and the
+        # predecessor index keep snapshots of them
+        state, nextState = state.copy(), nextState.copy()
+        key = (self.stateKey(state), action)
+        self.model[key] = (state, nextState, reward, duration)
+        self.predecessors.setdefault(self.stateKey(nextState), set()).add(key)
+        self.queuePredecessors(state)
+        self.plan()
+
+    def push(self, key, priority):
+        """
+        Queues key with priority unless it is already queued with at
+        least that priority. Outdated heap entries are skipped in pop.
+        """
+        if priority <= self.theta or self.queued.get(key, 0.0) >= priority:
+            return
+        self.queued[key] = priority
+        heapq.heappush(self.queue, (-priority, next(self.counter), key))
+
+    def pop(self):
+        while self.queue:
+            priority, _, key = heapq.heappop(self.queue)
+            if self.queued.get(key) == -priority:
+                del self.queued[key]
+                return key
+        return None
+
+    def queuePredecessors(self, state):
+        for key in self.predecessors.get(self.stateKey(state), ()):
+            predecessor, nextState, reward, duration = self.model[key]
+            self.push(key, abs(self.tdError(predecessor, key[1], nextState, reward, duration)))
+
+    def plan(self):
+        """
+        Runs up to planningSteps model updates, largest TD error first,
+        within planningTime seconds if set.
+        """
+        deadline = time.perf_counter() + self.planningTime if self.planningTime is not None else None
+        for _ in range(self.planningSteps):
+            key = self.pop()
+            if key is None:
+                break
+            state, nextState, reward, duration = self.model[key]
+            self.learn(state, key[1], nextState, reward, duration, self.getAlpha(state, key[1]))
+            self.planningUpdates += 1
+            self.queuePredecessors(state)
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+
+    def stopTraining(self):
+        QLearningAgent.stopTraining(self)
+        self.planningSteps = 0
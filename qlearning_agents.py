@@ -1,18 +1,36 @@
 
 
 import random, util
-from feature_extractors import TrafficLightExtractor
+import numpy as np
+import optimizers
+from feature_extractors import TrafficLightExtractor, NormalizedFeatureExtractor
 from agents import ReinforcementAgent
+from states import TFState, ACTIONS, ACTION_INDEX
+from qtable import BoundedQTable
 
 
 class QLearningAgent(ReinforcementAgent):
     """
       Q-Learning Agent.
+
+      qTable - optional store for the Q-values, e.g. a
+               qtable.BoundedQTable to train in a fixed amount of memory.
+               Visit counts (for visit-count alpha schedules) are then
+               kept in a table with the same budget, without spilling.
     """
-    def __init__(self, **args):
+    def __init__(self, qTable=None, **args):
         "You can initialize Q-values here..."
         ReinforcementAgent.__init__(self, **args)
-        self.qValues = util.Counter()
+        if qTable is None:
+            # SparseVector reads do not insert, so only updated pairs take memory
+            self.qValues = util.SparseVector()
+            self.visitCounts = util.SparseVector(self.qValues.vocabulary)
+        else:
+            self.qValues = qTable
+            self.visitCounts = BoundedQTable(qTable.maxEntries, qTable.policy)
+
+    def getVisitCount(self, state, action):
+        return self.visitCounts[(state, action)]
 
 
     def getQValue(self, state, action):
@@ -47,9 +65,12 @@ class QLearningAgent(ReinforcementAgent):
         if not legalActions:
             returnAction = None
         else:
-            maxQValue = self.computeValueFromQValues(state)
+            # Evaluate every Q-value once: the table may be shared with
+            # other processes and change between two reads
+            qValues = [self.getQValue(state, action) for action in legalActions]
+            maxQValue = max(qValues)
             # Use a small tolerance for float comparison
-            bestActions = [action for action in legalActions if self.getQValue(state, action) >= maxQValue - 1e-10]
+            bestActions = [action for action, qValue in zip(legalActions, qValues) if qValue >= maxQValue - 1e-10]
             returnAction = random.choice(bestActions)
         return returnAction
 
@@ -64,21 +85,23 @@ class QLearningAgent(ReinforcementAgent):
         # Pick Action
         legalActions = self.getLegalActions(state)
         action = None
-        if util.flipCoin(self.epsilon):
+        if util.flipCoin(self.getEpsilon()):
             action = random.choice(legalActions) if legalActions else None
         else:
             action = self.computeActionFromQValues(state)
         return action
 
-    def update(self, state, action, nextState, reward):
+    def update(self, state, action, nextState, reward, duration=1):
         """
           The parent class calls this to observe a
           state = action => nextState and reward transition.
           You should do your Q-Value update here
         """
-        sample = reward + self.discount * self.computeValueFromQValues(nextState)
-        newQValue = (1 - self.alpha) * self.getQValue(state, action) + self.alpha * sample
+        alpha = self.getAlpha(state, action)
+        sample = reward + self.discount ** duration * self.computeValueFromQValues(nextState)
+        newQValue = (1 - alpha) * self.getQValue(state, action) + alpha * sample
         self.qValues[(state, action)] = newQValue
+        self.visitCounts[(state, action)] += 1
 
     def getPolicy(self, state):
         return self.computeActionFromQValues(state)
@@ -87,36 +110,187 @@ class QLearningAgent(ReinforcementAgent):
         return self.computeValueFromQValues(state)
 
 
+class DoubleQLearningAgent(QLearningAgent):
+    """
+    Double Q-Learning (van Hasselt, 2010): two tables, A and B. Each update
+    picks one at random and bootstraps from the other table's value of the
+    action the updated table considers best, which removes the upward bias
+    of max over noisy estimates. Actions are chosen on the mean of both.
+    """
+    def __init__(self, **args):
+        QLearningAgent.__init__(self, **args)
+        if isinstance(self.qValues, util.SparseVector):
+            self.qValuesB = util.SparseVector(self.qValues.vocabulary)
+        else:
+            self.qValuesB = BoundedQTable(self.qValues.maxEntries, self.qValues.policy)
+
+    def getQValue(self, state, action):
+        return 0.5 * (self.qValues[(state, action)] + self.qValuesB[(state, action)])
+
+    def update(self, state, action, nextState, reward, duration=1):
+        if util.flipCoin(0.5):
+            table, other = self.qValues, self.qValuesB
+        else:
+            table, other = self.qValuesB, self.qValues
+        value = 0.0
+        legalActions = self.getLegalActions(nextState)
+        if legalActions:
+            qValues = [table[(nextState, a)] for a in legalActions]
+            maxQValue = max(qValues)
+            best = random.choice([a for a, q in zip(legalActions, qValues) if q >= maxQValue - 1e-10])
+            value = other[(nextState, best)]
+        alpha = self.getAlpha(state, action)
+        sample = reward + self.discount ** duration * value
+        table[(state, action)] = (1 - alpha) * table[(state, action)] + alpha * sample
+        self.visitCounts[(state, action)] += 1
+
+
+class EncodedQAgent(QLearningAgent):
+    """
+    Tabular Q-Learning over a dense (numStates, 2) array indexed by a
+    states.TFStateEncoder, instead of a table keyed by full TFStates.
+
+    The array is passed in, so it can be a view on shared memory that
+    several processes update without locks (see parallel_training.py):
+    concurrent read-modify-writes of the same entry may occasionally lose
+    an update, which Q-learning tolerates.
+
+    Visit counts (for visit-count alpha schedules) are kept per encoded
+    (state, action) in the dense visitCounts array, a new private one
+    unless passed in.
+    """
+
+    def __init__(self, table, encoder, visitCounts=None, **args):
+        QLearningAgent.__init__(self, **args)
+        self.table = table
+        self.encoder = encoder
+        self.visitCounts = visitCounts if visitCounts is not None else np.zeros(table.shape, dtype=np.int64)
+
+    def getVisitCount(self, state, action):
+        return int(self.visitCounts[self.encoder.encode(state), ACTION_INDEX[action]])
+
+    def getQValue(self, state, action):
+        return float(self.table[self.encoder.encode(state), ACTION_INDEX[action]])
+
+    def update(self, state, action, nextState, reward, duration=1):
+        index = self.encoder.encode(state)
+        column = ACTION_INDEX[action]
+        sample = reward + self.discount ** duration * self.computeValueFromQValues(nextState)
+        self.table[index, column] += self.getAlpha(state, action) * (sample - self.table[index, column])
+        self.visitCounts[index, column] += 1
+
+
 class TrafficApproximateQAgent(QLearningAgent):
     """
     Approximate Q-Learning Agent for Traffic Lights.
+
+    optimizer - 'sgd' (plain update), 'rmsprop' or 'adam', or an
+                optimizers.Optimizer instance
+    normalize - scale features by their running RMS so that the step
+                size does not depend on how many cars are waiting
+    targetSync - if set, bootstrap from a copy of the weights that is
+                 refreshed every targetSync updates instead of from the
+                 weights being updated
+
+    Weights are a util.SparseVector; features are turned into index and
+    value arrays so dot products and updates run in NumPy. Extractors with
+    a fixed number of features (numFeatures and getSparseFeatures(), e.g.
+    feature_specs.SpecFeatureExtractor) provide those arrays directly.
     """
-    def __init__(self, **args):
-        self.featExtractor = TrafficLightExtractor()
+    def __init__(self, extractor=None, optimizer='sgd', normalize=False, targetSync=None, **args):
+        self.featExtractor = extractor if extractor is not None else TrafficLightExtractor()
+        if normalize:
+            self.featExtractor = NormalizedFeatureExtractor(self.featExtractor)
         QLearningAgent.__init__(self, **args)
-        self.weights = util.Counter()
+        self.sparse = hasattr(self.featExtractor, 'getSparseFeatures')
+        if self.sparse:
+            self.weights = util.SparseVector(util.Vocabulary(range(self.featExtractor.numFeatures)))
+        else:
+            self.weights = util.SparseVector()
+        self.optimizer = optimizers.getOptimizer(optimizer)
+        self.targetSync = targetSync
+        self.targetWeights = None
+        self.updates = 0
+        if targetSync:
+            self.targetWeights = util.SparseVector(self.weights.vocabulary, len(self.weights.values))
+            self.syncTargetWeights()
 
     def getWeights(self):
         return self.weights
 
+    def fixFeatureVocabulary(self):
+        """
+          Adds every feature the extractor can produce to the weights'
+          vocabulary, in a deterministic order, so that feature indices
+          are known up front (shared, distributed or offline training).
+          Returns the number of features.
+        """
+        if not self.sparse:
+            state = TFState('GREEN', 'RED', 1, 1)
+            for action in ACTIONS:
+                for feature in sorted(self.featExtractor.getFeatures(state, action).keys()):
+                    self.weights.vocabulary.add(feature)
+            self.weights.reserve(len(self.weights.vocabulary))
+        return len(self.weights.vocabulary)
+
     def getQValue(self, state, action):
         """
           Should return Q(state,action) = w * featureVector
           where * is the dotProduct operator
         """
+        indices, values = self.getFeatureVector(state, action)
+        return self.weights.dot(indices, values)
+
+    def syncTargetWeights(self):
+        """
+          Copies the weights into the target weights. The target array is
+          only reallocated when the weights have grown.
+        """
+        if len(self.targetWeights.values) != len(self.weights.values):
+            self.targetWeights.values = np.empty_like(self.weights.values)
+        np.copyto(self.targetWeights.values, self.weights.values)
+
+    def computeTargetValue(self, state):
+        """
+          max_action Q(state, action) under the target weights (the
+          current weights without targetSync).
+        """
+        if self.targetWeights is None:
+            return self.computeValueFromQValues(state)
+        legalActions = self.getLegalActions(state)
+        if not legalActions:
+            return 0.0
+        return max(self.targetWeights.dot(*self.getFeatureVector(state, action)) for action in legalActions)
+
+    def getFeatureVector(self, state, action, add=False):
+        """
+          The features of (state, action) as (indices, values) arrays over
+          the weights' vocabulary. Unknown features get index -1 unless
+          add is True.
+        """
+        if self.sparse:
+            return self.featExtractor.getSparseFeatures(state, action)
         features = self.featExtractor.getFeatures(state, action)
-        qValue = 0
-        for feature in features:
-            qValue += self.weights[feature] * features[feature]
-        return qValue
+        indices = self.weights.vocabulary.lookupAll(features.keys(), add)
+        return indices, np.fromiter(features.values(), dtype=np.float64, count=len(features))
 
-    def update(self, state, action, nextState, reward):
+    def update(self, state, action, nextState, reward, duration=1):
         """
            Should update your weights based on transition
         """
-        difference = (reward + self.discount * self.computeValueFromQValues(nextState)) - self.getQValue(state, action)
-        features = self.featExtractor.getFeatures(state, action)
-        prevWeights = self.getWeights()
-        for feature in features:
-            self.weights[feature] = prevWeights[feature] + self.alpha * difference * features[feature]
+        difference = (reward + self.discount ** duration * self.computeTargetValue(nextState)) - self.getQValue(state, action)
+        indices, values = self.getFeatureVector(state, action, add=True)
+        self.weights.reserve(len(self.weights.vocabulary))
+        self.optimizer.step(self.weights.values, indices, difference * values, self.getAlpha(state, action))
+        if isinstance(self.featExtractor, NormalizedFeatureExtractor):
+            self.featExtractor.observe(state, action)
+        self.updates += 1
+        if self.targetSync and self.updates % self.targetSync == 0:
+            self.syncTargetWeights()
+
+    def stopTraining(self):
+        QLearningAgent.stopTraining(self)
+        # Test episodes must see the features scaled as during training
+        if isinstance(self.featExtractor, NormalizedFeatureExtractor):
+            self.featExtractor.freeze()
 
@@ -0,0 +1,178 @@
+"""
+A Q-table with a fixed memory budget: BoundedQTable evicts LRU or LFU
+entries beyond maxEntries and can spill them to an on-disk dbm file.
+"""
+
+import dbm
+import pickle
+from collections import OrderedDict
+
+
+def serializeKey(key):
+    """
+    Canonical bytes of a Q-table key such as (TFState, action). Objects
+    with a key() method (TFState) are replaced by it, so equal states
+    always map to the same bytes.
+    """
+    if isinstance(key, tuple):
+        key = tuple(k.key() if hasattr(k, 'key') else k for k in key)
+    elif hasattr(key, 'key'):
+        key = key.key()
+    return pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def snapshotKey(key):
+    """
+    Copy of a Q-table key in which objects with a key() method (TFState)
+    are replaced by snapshots, so the table never holds a state the
+    caller keeps stepping.
+    """
+    if isinstance(key, tuple):
+        return tuple(k.copy() if hasattr(k, 'key') else k for k in key)
+    return key.copy() if hasattr(key, 'key') else key
+
+
+class BoundedQTable:
+    """
+    Dict-like table of floats with LRU/LFU eviction and optional disk spill.
+    Spilled values are faulted back into memory when read or updated;
+    without a spill file evicted values read as the default again. Like
+    util.SparseVector, reading a missing key does not insert it.
+
+    maxEntries - number of values kept in memory. The budget is an entry
+                 count, not bytes: with (TFState, action) keys an entry
+                 takes about 450 bytes (the key's snapshot, its dict
+                 entries and the LRU/LFU bookkeeping)
+    policy     - 'lru' or 'lfu'
+    spillPath  - dbm file for evicted values (None drops them)
+    """
+    def __init__(self, maxEntries=1000000, policy='lru', spillPath=None, default=0.0):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+        self.maxEntries = max(1, int(maxEntries))
+        self.policy = policy
+        self.default = default
+        self.values = {}
+        # LRU: keys in access order. LFU: key -> use count, and per count
+        # the keys in insertion order (oldest first). Buckets map a key to
+        # the stored key object, so moving it never re-inserts a caller's
+        # (possibly still changing) key
+        self.order = OrderedDict()
+        self.frequency = {}
+        self.buckets = {}
+        self.minFrequency = 0
+        self.disk = dbm.open(spillPath, 'n') if spillPath is not None else None
+        self.spilled = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spills = 0
+        self.faults = 0
+
+    def touch(self, key):
+        if self.policy == 'lru':
+            self.order.move_to_end(key)
+            return
+        count = self.frequency[key]
+        bucket = self.buckets[count]
+        storedKey = bucket.pop(key)
+        if not bucket:
+            del self.buckets[count]
+            if self.minFrequency == count:
+                self.minFrequency = count + 1
+        self.frequency[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[storedKey] = storedKey
+
+    def insert(self, key, value):
+        if len(self.values) >= self.maxEntries:
+            self.evict()
+        key = snapshotKey(key)
+        self.values[key] = value
+        if self.policy == 'lru':
+            self.order[key] = None
+        else:
+            self.frequency[key] = 1
+            self.buckets.setdefault(1, OrderedDict())[key] = key
+            self.minFrequency = 1
+
+    def evict(self):
+        if self.policy == 'lru':
+            key, _ = self.order.popitem(last=False)
+        else:
+            bucket = self.buckets[self.minFrequency]
+            key, _ = bucket.popitem(last=False)
+            if not bucket:
+                del self.buckets[self.minFrequency]
+            del self.frequency[key]
+        value = self.values.pop(key)
+        self.evictions += 1
+        if self.disk is not None:
+            # Keep the stored key object too: the key a value is later read
+            # with may be a live state that keeps changing. TFStates pickle
+            # without their VehicleTracker and random generator
+            self.disk[serializeKey(key)] = pickle.dumps((key, value), protocol=pickle.HIGHEST_PROTOCOL)
+            self.spilled += 1
+            self.spills += 1
+
+    def fault(self, key):
+        """
+        Moves key back from disk into memory. Returns False if it is not
+        on disk.
+        """
+        if not self.spilled:
+            return False
+        serialized = serializeKey(key)
+        try:
+            stored = self.disk[serialized]
+        except KeyError:
+            return False
+        del self.disk[serialized]
+        self.spilled -= 1
+        self.faults += 1
+        storedKey, value = pickle.loads(stored)
+        self.insert(storedKey, value)
+        return True
+
+    def __getitem__(self, key):
+        if key in self.values:
+            self.hits += 1
+            self.touch(key)
+            return self.values[key]
+        self.misses += 1
+        if self.fault(key):
+            return self.values[key]
+        return self.default
+
+    def __setitem__(self, key, value):
+        if key in self.values:
+            self.values[key] = value
+            self.touch(key)
+            return
+        if self.fault(key):
+            self.values[key] = value
+            return
+        self.insert(key, value)
+
+    def __contains__(self, key):
+        return key in self.values or (self.spilled > 0 and serializeKey(key) in self.disk)
+
+    def __len__(self):
+        return len(self.values) + self.spilled
+
+    def getStats(self):
+        lookups = self.hits + self.misses
+        return {
+            'in_memory': len(self.values),
+            'on_disk': self.spilled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'spills': self.spills,
+            'faults': self.faults,
+        }
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
@@ -0,0 +1,215 @@
+"""
+Recording and replaying headless runs: ReplayRecorder writes one binary
+frame per tick, and ReplayViewer memory-maps the file and plays it back
+in the GUI (`python replay.py <file>`).
+"""
+
+import struct
+import numpy as np
+import tkinter as tk
+from states import TFState, ACTIONS
+from ui import TrafficLightUI
+
+# A replay file is HEADER (magic, version) followed by FRAME records,
+# one per tick. A frame with action NO_ACTION is the initial state of an
+# episode.
+MAGIC = b'TFRP'
+VERSION = 1
+HEADER = struct.Struct('<4sI')
+NO_ACTION = 255
+COLORS = ('RED', 'YELLOW', 'GREEN')
+FRAME = np.dtype([
+    ('tick', '<u4'),
+    ('ns', '<u4'),
+    ('ew', '<u4'),
+    ('light_ns', 'u1'),
+    ('light_ew', 'u1'),
+    ('action', 'u1'),
+])
+
+
+class ReplayRecorder:
+    """
+    Appends frames to a replay file through a preallocated buffer of
+    bufferFrames frames, written out whenever it fills up. Close it (or
+    use it as a context manager) to write out the rest.
+    """
+    def __init__(self, path, bufferFrames=65536):
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.buffer = np.zeros(bufferFrames, dtype=FRAME)
+        self.size = 0
+        self.frames = 0
+
+    def recordValues(self, tick, ns, ew, light_ns, light_ew, action):
+        if self.size == len(self.buffer):
+            self.flush()
+        self.buffer[self.size] = (tick, ns, ew, COLORS.index(light_ns), COLORS.index(light_ew),
+                                  NO_ACTION if action is None else ACTIONS.index(action))
+        self.size += 1
+        self.frames += 1
+
+    def record(self, state, action=None):
+        """
+        Records state as it is after taking action (None for the initial
+        state of an episode).
+        """
+        self.recordValues(state.tick, state.num_cars_waiting_ns, state.num_cars_waiting_ew,
+                          state.light_color_ns, state.light_color_ew, action)
+
+    def recordTrace(self, start, trace, end):
+        """
+        Records every tick of a TFState.macroStep from start (the state
+        before it), its trace of (ns, ew, action) before every tick and end
+        (the state after it).
+        """
+        ns_green = start.light_color_ns == 'GREEN'
+        for i, (_, _, action) in enumerate(trace):
+            if action == 'SWITCH':
+                ns_green = not ns_green
+            if i + 1 < len(trace):
+                ns, ew = trace[i + 1][0], trace[i + 1][1]
+            else:
+                ns, ew = end.num_cars_waiting_ns, end.num_cars_waiting_ew
+            self.recordValues(start.tick + i + 1, ns, ew, 'GREEN' if ns_green else 'RED',
+                              'RED' if ns_green else 'GREEN', action)
+
+    def flush(self):
+        self.file.write(self.buffer[:self.size].tobytes())
+        self.size = 0
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def openReplay(path):
+    """
+    The frames of a replay file as a read-only memory-mapped FRAME array.
+    """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} replay file")
+    return np.memmap(path, dtype=FRAME, mode='r', offset=HEADER.size)
+
+
+def frameToState(frame):
+    """
+    A TFState showing one frame, for TrafficLightUI.update.
+    """
+    state = TFState(COLORS[frame['light_ns']], COLORS[frame['light_ew']], int(frame['ns']), int(frame['ew']))
+    state.tick = int(frame['tick'])
+    return state
+
+
+class ReplayViewer:
+    """
+    Plays a replay file in a TrafficLightUI.
+
+    speed - frames per second while playing. Above `fps` redraws per
+            second frames are skipped, so any speed costs the same to draw.
+    """
+    def __init__(self, root, path, speed=10.0, fps=30):
+        self.root = root
+        self.frames = openReplay(path)
+        self.speed = float(speed)
+        self.fps = fps
+        self.position = 0.0
+        self.playing = False
+        self.timer = None
+        # Frames where an episode starts, for jumping between episodes
+        self.episodeStarts = np.flatnonzero(self.frames['action'] == NO_ACTION)
+
+        self.ui = TrafficLightUI(root)
+        self.root.title(f"Replay: {path}")
+        controls = tk.Frame(root)
+        controls.pack(fill=tk.X)
+        tk.Button(controls, text="<<", command=self.previousEpisode).pack(side=tk.LEFT)
+        tk.Button(controls, text="<", command=lambda: self.seek(self.position - 1)).pack(side=tk.LEFT)
+        self.playButton = tk.Button(controls, text="Play", command=self.toggle)
+        self.playButton.pack(side=tk.LEFT)
+        tk.Button(controls, text=">", command=lambda: self.seek(self.position + 1)).pack(side=tk.LEFT)
+        tk.Button(controls, text=">>", command=self.nextEpisode).pack(side=tk.LEFT)
+        tk.Button(controls, text="x0.5", command=lambda: self.setSpeed(self.speed / 2)).pack(side=tk.LEFT)
+        tk.Button(controls, text="x2", command=lambda: self.setSpeed(self.speed * 2)).pack(side=tk.LEFT)
+        self.info = tk.Label(controls, text="")
+        self.info.pack(side=tk.LEFT, padx=10)
+        self.slider = tk.Scale(root, from_=0, to=max(len(self.frames) - 1, 0), orient=tk.HORIZONTAL,
+                               showvalue=False, command=self.onSlider)
+        self.slider.pack(fill=tk.X)
+        self.show()
+
+    def seek(self, position):
+        self.position = float(min(max(position, 0), len(self.frames) - 1))
+        self.slider.set(int(self.position))
+        self.show()
+
+    def onSlider(self, value):
+        # Also called back for slider.set() in seek; keep the fractional
+        # position of fast playback in that case
+        if int(value) != int(self.position):
+            self.seek(int(value))
+
+    def show(self):
+        if not len(self.frames):
+            return
+        index = int(self.position)
+        frame = self.frames[index]
+        action = 'start' if frame['action'] == NO_ACTION else ACTIONS[frame['action']]
+        self.info.config(text=f"Frame {index + 1}/{len(self.frames)}  {action}  {self.speed:g} fps")
+        self.ui.update(frameToState(frame))
+
+    def setSpeed(self, speed):
+        self.speed = max(speed, 0.125)
+        self.show()
+
+    def toggle(self):
+        self.playing = not self.playing
+        self.playButton.config(text="Pause" if self.playing else "Play")
+        if self.playing:
+            self.tick()
+        elif self.timer is not None:
+            self.root.after_cancel(self.timer)
+            self.timer = None
+
+    def tick(self):
+        if not self.playing:
+            return
+        interval = 1.0 / min(self.speed, self.fps)
+        if self.position >= len(self.frames) - 1:
+            self.toggle()
+            return
+        self.seek(self.position + self.speed * interval)
+        self.timer = self.root.after(int(interval * 1000), self.tick)
+
+    def nextEpisode(self):
+        later = self.episodeStarts[self.episodeStarts > int(self.position)]
+        self.seek(later[0] if len(later) else len(self.frames) - 1)
+
+    def previousEpisode(self):
+        earlier = self.episodeStarts[self.episodeStarts < int(self.position)]
+        self.seek(earlier[-1] if len(earlier) else 0)
+
+
+def view(path, speed=10.0):
+    root = tk.Tk()
+    ReplayViewer(root, path, speed)
+    root.mainloop()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Replay a run recorded with ReplayRecorder.')
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=10.0, help='frames per second')
+    args = parser.parse_args()
+    view(args.path, args.speed)
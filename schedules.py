@@ -0,0 +1,104 @@
+import math
+import util
+
+
+class Schedule:
+    """
+    A schedule maps a counter to a hyperparameter value (learning rate or
+    exploration rate).
+
+    The counter a schedule is indexed by is given by its `unit`:
+    - 'step':    number of ticks observed by the agent (a macro step of
+                 TFState.macroStep counts as its duration in ticks, so
+                 step schedules decay alike with and without macro steps)
+    - 'episode': number of finished episodes
+    - 'visit':   number of times the (state, action) pair was updated
+                 (only meaningful for the tabular agent's alpha)
+    """
+    unit = 'step'
+
+    def getValue(self, t):
+        util.raiseNotDefined()
+
+    def __call__(self, t):
+        return self.getValue(t)
+
+
+class ConstantSchedule(Schedule):
+    """
+    Always returns the same value.
+    """
+    def __init__(self, value, unit='step'):
+        self.value = float(value)
+        self.unit = unit
+
+    def getValue(self, t):
+        return self.value
+
+
+class LinearDecaySchedule(Schedule):
+    """
+    Interpolates linearly from `initial` to `final` over `duration` units
+    and stays at `final` afterwards.
+    """
+    def __init__(self, initial, final, duration, unit='step'):
+        self.initial = float(initial)
+        self.final = float(final)
+        self.duration = max(1, int(duration))
+        self.unit = unit
+
+    def getValue(self, t):
+        fraction = min(1.0, float(t) / self.duration)
+        return self.initial + fraction * (self.final - self.initial)
+
+
+class ExponentialDecaySchedule(Schedule):
+    """
+    initial * decay ** t, never going below `minimum`.
+    """
+    def __init__(self, initial, decay, minimum=0.0, unit='step'):
+        self.initial = float(initial)
+        self.decay = float(decay)
+        self.minimum = float(minimum)
+        self.unit = unit
+
+    def getValue(self, t):
+        return max(self.minimum, self.initial * self.decay ** t)
+
+
+class EpisodeSchedule(Schedule):
+    """
+    One value per episode. Once the list runs out the last value is kept,
+    e.g. EpisodeSchedule([0.3, 0.2, 0.1, 0.05]) for epsilon.
+    """
+    unit = 'episode'
+
+    def __init__(self, values):
+        if not values:
+            raise ValueError("EpisodeSchedule needs at least one value")
+        self.values = [float(v) for v in values]
+
+    def getValue(self, t):
+        return self.values[min(int(t), len(self.values) - 1)]
+
+
+class VisitCountSchedule(Schedule):
+    """
+    Per (state, action) learning rate for the tabular agent:
+
+        alpha(n) = max(minimum, initial / (1 + n) ** power)
+
+    where n is the number of previous updates of that pair. With
+    0.5 < power <= 1 this satisfies the usual stochastic approximation
+    conditions, so rarely seen states still learn fast while frequently
+    seen ones settle.
+    """
+    unit = 'visit'
+
+    def __init__(self, initial=1.0, power=0.8, minimum=0.0):
+        self.initial = float(initial)
+        self.power = float(power)
+        self.minimum = float(minimum)
+
+    def getValue(self, t):
+        return max(self.minimum, self.initial / math.pow(1 + t, self.power))
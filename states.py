@@ -1,5 +1,23 @@
 import math
 import random
+from vehicle_queues import VehicleTracker
+
+# Switching rules: the light has to stay at least MIN_TICKS_BEFORE_SWITCH
+# ticks after a switch and is forced to switch after MAX_TICKS_BEFORE_SWITCH
+MIN_TICKS_BEFORE_SWITCH = 2
+MAX_TICKS_BEFORE_SWITCH = 13
+# Actions in the order used by every array indexed by action
+ACTIONS = ('SWITCH', 'STAY')
+ACTION_INDEX = {action: i for i, action in enumerate(ACTIONS)}
+# Switching before PENALTY_THRESHOLD ticks costs PENALTY_AMOUNT ('penalty' reward)
+PENALTY_THRESHOLD = 5
+PENALTY_AMOUNT = 50
+# Cars leaving a green direction per tick
+DEPARTURE_RATE = 4
+# Arrivals per tick: BASE + AMPLITUDE * sin(2 pi tick / ticks_per_episode) + U(-NOISE, NOISE)
+ARRIVAL_BASE = 2
+ARRIVAL_AMPLITUDE = 1.5
+ARRIVAL_NOISE = 0.5
 
 class TFState:
     """
@@ -20,19 +38,36 @@ class TFState:
         self.ticks_since_last_switch = 0
         self.last_action_penalty = 0
         self.ticks_per_episode = ticks_per_episode
+        # Optional VehicleTracker (see enableVehicleTracking)
+        self.vehicles = None
+        # Optional random.Random for arrivals; the random module if None
+        self.random = None
         # print(f"Initialized TFState: {self}")
 
+    def key(self):
+        """
+        The attributes that identify a state, as a tuple. Equal states have
+        equal keys, so it can stand in for the state e.g. when serializing.
+        """
+        return (self.light_color_ns, self.light_color_ew, self.num_cars_waiting_ns, self.num_cars_waiting_ew, self.tick, self.reward_type, self.ticks_since_last_switch)
+
+    def __getstate__(self):
+        """
+        Pickles leave out the VehicleTracker and random generator: they
+        belong to the running simulation rather than to the state, and
+        would make every pickled snapshot (saved agents, spilled Q-table
+        entries) as large as the whole tracker.
+        """
+        state = self.__dict__.copy()
+        state['vehicles'] = None
+        state['random'] = None
+        return state
+
     def __eq__(self, other):
-        return (self.light_color_ns == other.light_color_ns and
-                self.light_color_ew == other.light_color_ew and
-                self.num_cars_waiting_ns == other.num_cars_waiting_ns and
-                self.num_cars_waiting_ew == other.num_cars_waiting_ew and
-                self.tick == other.tick and
-                self.reward_type == other.reward_type and
-                self.ticks_since_last_switch == other.ticks_since_last_switch)
+        return self.key() == other.key()
 
     def __hash__(self):
-        return hash((self.light_color_ns, self.light_color_ew, self.num_cars_waiting_ns, self.num_cars_waiting_ew, self.tick, self.reward_type, self.ticks_since_last_switch))
+        return hash(self.key())
     
     def __str__(self):
         return f"TFState(light_color_ns={self.light_color_ns}, light_color_ew={self.light_color_ew}, num_cars_waiting_ns={self.num_cars_waiting_ns}, num_cars_waiting_ew={self.num_cars_waiting_ew}, tick={self.tick}, reward_type={self.reward_type}, last_switch={self.ticks_since_last_switch})"
@@ -43,21 +78,69 @@ class TFState:
         Possible actions could be 'SWITCH', or 'STAY'.
         """
         cannonical_actions = ['SWITCH', 'STAY']
-        if self.ticks_since_last_switch < 2:
+        if self.ticks_since_last_switch < MIN_TICKS_BEFORE_SWITCH:
             return ['STAY']
-        if self.ticks_since_last_switch >= 13:
+        if self.ticks_since_last_switch >= MAX_TICKS_BEFORE_SWITCH:
             return ['SWITCH']
         return cannonical_actions
     
+    def enableVehicleTracking(self, tracker=None):
+        """
+        Tracks individual vehicles on top of the counts: the cars already
+        waiting are taken to have arrived at the current tick. Returns the
+        VehicleTracker, whose getStats() reports per-vehicle wait times.
+        """
+        self.vehicles = tracker if tracker is not None else VehicleTracker()
+        self.vehicles.arrive('ns', self.tick, self.num_cars_waiting_ns)
+        self.vehicles.arrive('ew', self.tick, self.num_cars_waiting_ew)
+        return self.vehicles
+
+    def copy(self):
+        """
+        Returns a snapshot of this state as a shallow copy (much cheaper
+        than copy.deepcopy). Every attribute but two is an immutable value:
+        the mutable `vehicles` tracker and `random` generator are shared
+        with the snapshot, not copied, so stepping either state moves
+        them on for both. Keys, equality and pickles ignore them.
+        """
+        snapshot = TFState.__new__(TFState)
+        snapshot.__dict__.update(self.__dict__)
+        return snapshot
+
     def updateState(self, action):
         """
         Updates the state based on the action taken.
         """
+        self.applyAction(action)
+        new_cars = self.sampleArrivals()
+        
+        # Distribute new cars between directions
+        ns_arrivals = 3 * new_cars // 5
+        self.num_cars_waiting_ns += ns_arrivals
+        self.num_cars_waiting_ew += new_cars - ns_arrivals
+        waiting_ns, waiting_ew = self.num_cars_waiting_ns, self.num_cars_waiting_ew
+
+        # Handle departures (cars leaving if light is green)
+        departure_rate = DEPARTURE_RATE
+        if self.light_color_ns == 'GREEN' and self.num_cars_waiting_ns > 0:
+            self.num_cars_waiting_ns = max(0, self.num_cars_waiting_ns - departure_rate)
+        if self.light_color_ew == 'GREEN' and self.num_cars_waiting_ew > 0:
+            self.num_cars_waiting_ew = max(0, self.num_cars_waiting_ew - departure_rate)
+
+        if self.vehicles is not None:
+            self.vehicles.step(self.tick, ns_arrivals, new_cars - ns_arrivals,
+                               waiting_ns - self.num_cars_waiting_ns, waiting_ew - self.num_cars_waiting_ew)
+
+    def applyAction(self, action):
+        """
+        Advances the tick and applies the action to the lights, the switch
+        counter and the switching penalty. Queues are not touched.
+        """
         self.tick += 1
 
         # Logic for switching penalty
-        penalty_threshold = 5
-        penalty_amount = 50
+        penalty_threshold = PENALTY_THRESHOLD
+        penalty_amount = PENALTY_AMOUNT
         
         if action == 'SWITCH':
             if self.ticks_since_last_switch < penalty_threshold:
@@ -75,32 +158,106 @@ class TFState:
         else:
             self.ticks_since_last_switch += 1
             self.last_action_penalty = 0
-        
+
+    def sampleArrivals(self):
+        """
+        Number of cars arriving at the current tick.
+        """
         # Sine wave arrival logic
         period = self.ticks_per_episode  # Adjust as needed
-        amplitude = 1.5
-        base = 2
-        epsilon = 0.5 # Noise magnitude
+        amplitude = ARRIVAL_AMPLITUDE
+        base = ARRIVAL_BASE
+        epsilon = ARRIVAL_NOISE # Noise magnitude
 
         # Calculate base arrival rate with sine wave
         arrival_rate = base + amplitude * math.sin(2 * math.pi * self.tick / period)
         
         # Add noise
-        noise = random.uniform(-epsilon, epsilon)
+        noise = (self.random if self.random is not None else random).uniform(-epsilon, epsilon)
         
         # Total cars to add (ensure non-negative)
-        new_cars = int(max(0, round(arrival_rate + noise)))
-        
-        # Distribute new cars between directions
-        self.num_cars_waiting_ns += 3* new_cars // 5
-        self.num_cars_waiting_ew += new_cars - (3 * new_cars // 5)
+        return int(max(0, round(arrival_rate + noise)))
 
-        # Handle departures (cars leaving if light is green)
-        departure_rate = 4
-        if self.light_color_ns == 'GREEN' and self.num_cars_waiting_ns > 0:
-            self.num_cars_waiting_ns = max(0, self.num_cars_waiting_ns - departure_rate)
-        if self.light_color_ew == 'GREEN' and self.num_cars_waiting_ew > 0:
-            self.num_cars_waiting_ew = max(0, self.num_cars_waiting_ew - departure_rate)
+    def macroStep(self, action, discount=1.0, maxTicks=None, trace=None):
+        """
+        Takes `action` and then keeps applying the forced action while only
+        one action is legal (the STAY ticks right after a switch and the
+        SWITCH at MAX_TICKS_BEFORE_SWITCH), stopping at the next state with
+        a real decision or after maxTicks ticks.
+
+        Arrivals are drawn in the same order as with repeated updateState
+        calls, so both give the same trajectory for the same random seed.
+        If trace is a list, (ns, ew, action) before every tick is appended.
+
+        Returns (discountedReward, totalReward, ticks), where
+        discountedReward = sum_t discount^t * reward_t is the reward of the
+        whole option and ticks its duration.
+        """
+        ticks = []
+        while True:
+            self.applyAction(action)
+            ticks.append((action, self.light_color_ns == 'GREEN', self.sampleArrivals(), self.last_action_penalty))
+            legalActions = self.getLegalActions()
+            if len(legalActions) != 1 or (maxTicks is not None and len(ticks) >= maxTicks):
+                break
+            action = legalActions[0]
+
+        rewards = self.advanceQueues(ticks, trace)
+        discountedReward = 0.0
+        for t, reward in enumerate(rewards):
+            discountedReward += discount ** t * reward
+        return discountedReward, sum(rewards), len(ticks)
+
+    def advanceQueues(self, ticks, trace=None):
+        """
+        Queue update for the (action, ns_green, arrivals, penalty) ticks
+        recorded by macroStep. Over each stretch with a constant light the
+        red direction just accumulates arrivals and the green one follows
+        the Lindley recursion q_t = max(0, q_{t-1} + x_t), computed as
+        q_t = S_t - min(-q_0, min_{j<=t} S_j) with S_t the running sum of
+        x = arrivals - DEPARTURE_RATE. This is still a loop over the ticks:
+        every tick's reward (and the trace and vehicle tracker) needs the
+        queues after that tick, and options are at most
+        MAX_TICKS_BEFORE_SWITCH ticks, too short for NumPy to pay off.
+        Returns the reward of every tick.
+        """
+        final_penalty = self.last_action_penalty
+        tick = self.tick - len(ticks)
+        rewards = []
+        start = 0
+        while start < len(ticks):
+            ns_green = ticks[start][1]
+            end = start
+            while end < len(ticks) and ticks[end][1] == ns_green:
+                end += 1
+            green = self.num_cars_waiting_ns if ns_green else self.num_cars_waiting_ew
+            red = self.num_cars_waiting_ew if ns_green else self.num_cars_waiting_ns
+            cumulative = 0
+            lowest = -green
+            for action, _, arrivals, penalty in ticks[start:end]:
+                if trace is not None:
+                    trace.append((self.num_cars_waiting_ns, self.num_cars_waiting_ew, action))
+                ns_arrivals = 3 * arrivals // 5
+                ew_arrivals = arrivals - ns_arrivals
+                red += ew_arrivals if ns_green else ns_arrivals
+                cumulative += (ns_arrivals if ns_green else ew_arrivals) - DEPARTURE_RATE
+                lowest = min(lowest, cumulative)
+                previous = self.num_cars_waiting_ns if ns_green else self.num_cars_waiting_ew
+                if ns_green:
+                    self.num_cars_waiting_ns, self.num_cars_waiting_ew = cumulative - lowest, red
+                else:
+                    self.num_cars_waiting_ns, self.num_cars_waiting_ew = red, cumulative - lowest
+                tick += 1
+                if self.vehicles is not None:
+                    green_arrivals = ns_arrivals if ns_green else ew_arrivals
+                    departed = previous + green_arrivals - (cumulative - lowest)
+                    self.vehicles.step(tick, ns_arrivals, ew_arrivals,
+                                       departed if ns_green else 0, 0 if ns_green else departed)
+                self.last_action_penalty = penalty
+                rewards.append(self.getReward())
+            start = end
+        self.last_action_penalty = final_penalty
+        return rewards
 
     def getReward(self):
         """
@@ -146,4 +303,54 @@ class TFState:
         Returns the reward for the current state.
         A simple reward could be negative of total cars waiting.
         """
-        return - (self.num_cars_waiting_ns + self.num_cars_waiting_ew)
\ No newline at end of file
+        return - (self.num_cars_waiting_ns + self.num_cars_waiting_ew)
+
+
+class TFStateEncoder:
+    """
+    Maps a TFState to an integer in [0, numStates) by discretizing it:
+    NS phase (green or not), both queues capped at maxCars, ticks since the
+    last switch (0..MAX_TICKS_BEFORE_SWITCH) and the time of day in
+    timeBins bins of the ticks_per_episode period.
+
+    Used wherever a fixed-size table over states is needed (model-based
+    planning, shared or batched Q-tables).
+    """
+    def __init__(self, maxCars=30, timeBins=12, ticksPerEpisode=4320):
+        self.maxCars = int(maxCars)
+        self.timeBins = int(timeBins)
+        self.ticksPerEpisode = int(ticksPerEpisode)
+        self.numQueues = self.maxCars + 1
+        self.numSince = MAX_TICKS_BEFORE_SWITCH + 1
+        self.numStates = 2 * self.numQueues * self.numQueues * self.numSince * self.timeBins
+
+    def timeBin(self, tick):
+        return (tick % self.ticksPerEpisode) * self.timeBins // self.ticksPerEpisode
+
+    def encodeValues(self, phase, ns, ew, since, timeBin):
+        """
+        Index of already discretized components. Works elementwise on
+        NumPy arrays as well as on ints.
+        """
+        index = phase * self.numQueues + ns
+        index = index * self.numQueues + ew
+        index = index * self.numSince + since
+        return index * self.timeBins + timeBin
+
+    def encode(self, state):
+        return self.encodeValues(1 if state.light_color_ns == 'GREEN' else 0,
+                                 min(state.num_cars_waiting_ns, self.maxCars),
+                                 min(state.num_cars_waiting_ew, self.maxCars),
+                                 min(state.ticks_since_last_switch, MAX_TICKS_BEFORE_SWITCH),
+                                 self.timeBin(state.tick))
+
+    def decode(self, index):
+        """
+        Inverse of encodeValues: (phase, ns, ew, since, timeBin). Works
+        elementwise on NumPy arrays as well as on ints.
+        """
+        index, timeBin = divmod(index, self.timeBins)
+        index, since = divmod(index, self.numSince)
+        index, ew = divmod(index, self.numQueues)
+        phase, ns = divmod(index, self.numQueues)
+        return phase, ns, ew, since, timeBin
@@ -1,10 +1,14 @@
 import random
-import copy
 import util
 from ui import TrafficLightUI
 import tkinter as tk
-from states import TFState
-from qlearning_agents import QLearningAgent, TrafficApproximateQAgent
+from states import TFState, TFStateEncoder
+from qlearning_agents import QLearningAgent, DoubleQLearningAgent, TrafficApproximateQAgent
+from schedules import ExponentialDecaySchedule, VisitCountSchedule
+from feature_specs import SpecFeatureExtractor
+from value_iteration_agents import ValueIterationAgent
+from planning_agents import DynaQAgent
+from replay import ReplayRecorder
 
 def plot_results(history, switch_counts):
     """
@@ -85,13 +89,90 @@ def plot_results(history, switch_counts):
     plt.tight_layout()
     plt.show()
 
-def run_simulation(model_type='qlearning', episodes=10, steps_per_episode=50, reward_type='initial', use_gui=False):
+def run_episode(agent, state, steps_per_episode, current_data, recorder=None):
+    """
+    Runs one headless episode from `state`, asking the agent for an action
+    and letting it learn on every tick. Queue lengths before every tick are
+    appended to current_data['ns'] and current_data['ew'], and every tick
+    is recorded with recorder (a replay.ReplayRecorder) if given.
+
+    Returns the total reward and the number of switches.
+    """
+    total_reward = 0
+    current_switches = 0
+    for step in range(steps_per_episode):
+        # Record data
+        current_data['ns'].append(state.num_cars_waiting_ns)
+        current_data['ew'].append(state.num_cars_waiting_ew)
+
+        # 1. Get action from agent
+        action = agent.getAction(state)
+    
+        if action == 'SWITCH':
+            current_switches += 1
+    
+        # 2. Store current state for update (copy because updateState modifies in place)
+        prev_state = state.copy()
+    
+        # 3. Execute action (transition)
+        state.updateState(action)
+        next_state = state # state is now updated
+        if recorder is not None:
+            recorder.record(next_state, action)
+    
+        # 4. Calculate reward
+        reward = next_state.getReward()
+        total_reward += reward
+    
+        # 5. Update agent
+        agent.observeTransition(prev_state, action, next_state, reward)
+    
+        # Optional: Print step info
+        # print(f"Step {step}: Action={action}, Reward={reward}, State={state}")
+    return total_reward, current_switches
+
+def run_macro_episode(agent, state, steps_per_episode, current_data, recorder=None):
+    """
+    Runs one episode where the agent is only asked at decision points:
+    forced ticks (see TFState.macroStep) are advanced together with the
+    chosen action and learned from as a single option whose reward is
+    discounted over its duration.
+
+    Returns the total (undiscounted) reward and the number of switches.
+    """
+    total_reward = 0
+    current_switches = 0
+    step = 0
+    while step < steps_per_episode:
+        action = agent.getAction(state)
+        prev_state = state.copy()
+        trace = []
+        option_reward, reward, ticks = state.macroStep(action, agent.discount, steps_per_episode - step, trace)
+        if recorder is not None:
+            recorder.recordTrace(prev_state, trace, state)
+        for ns, ew, tick_action in trace:
+            current_data['ns'].append(ns)
+            current_data['ew'].append(ew)
+            if tick_action == 'SWITCH':
+                current_switches += 1
+        total_reward += reward
+        agent.observeTransition(prev_state, action, state, option_reward, ticks)
+        step += ticks
+    return total_reward, current_switches
+
+def run_simulation(model_type='qlearning', episodes=10, steps_per_episode=50, reward_type='initial', use_gui=False,
+                   macro_steps=False, convergence=None, track_vehicles=False, replay_path=None):
     """
     This function `run_simulation` runs a traffic simulation using different reinforcement
     learning models and can display the simulation in a GUI or non-GUI mode.
     
     :param model_type: The `model_type` parameter in the `run_simulation` function specifies the type of
-    reinforcement learning model to use for the simulation. It can take on different values:, defaults
+    reinforcement learning model to use for the simulation. It can take on different values:
+    'qlearning', 'qlearning_epsilon', 'qlearning_decay' (visit-count alpha and decaying epsilon),
+    'double_qlearning', 'dyna_q' (prioritized sweeping over discretized states), 'approximate' (normalized features with RMSProp steps), 'approximate_target'
+    (the same, bootstrapping from periodically synced target weights), 'approximate_tiles' (tile coded
+    features from feature_specs), 'approximate_sgd' and 'value_iteration' (optimal policy of the
+    discretized model, as a baseline), defaults
     to qlearning (optional)
 
     :param episodes: The `episodes` parameter in the `run_simulation` function specifies the number of
@@ -113,26 +194,73 @@ def run_simulation(model_type='qlearning', episodes=10, steps_per_episode=50, re
     simulation will be run with a graphical user interface (GUI) or not. If `use_gui` is set to `True`,
     the simulation will be displayed and interacted with using a GUI interface. The parameters `use_gui, 
     defaults to False (optional)
+
+    :param macro_steps: If True (and not in GUI mode), ticks where only one action is legal are
+    fast-forwarded together with the preceding decision, and the agent learns from the aggregated
+    discounted reward of the whole stretch instead of being queried every tick, defaults to False (optional)
+
+    :param convergence: An optional `convergence.ConvergenceMonitor` updated after every training
+    episode. Once it reports convergence the agent is checkpointed (if the monitor has a checkpoint
+    path) and, if its `stopEarly` is set, training ends and the test episode runs right away,
+    defaults to None (optional)
+
+    :param track_vehicles: If True (and not in GUI mode), individual vehicles are tracked on top of
+    the queue counts (see `TFState.enableVehicleTracking`) and the mean and 90th percentile wait of
+    the served cars are printed after every episode, defaults to False (optional)
+
+    :param replay_path: If set (and not in GUI mode), every tick of every episode is recorded to this
+    file, which `python replay.py <file>` plays back in the GUI, defaults to None (optional)
     
-    :return: The `run_simulation` function does not explicitly return any value. It either runs the
-    simulation with the specified parameters or prints out information during the simulation process.
-    The function is designed to perform a simulation based on the provided inputs and does not have a
-    specific return value.
+    :return: The trained agent (None for an unknown model type), so it can be saved with
+    `agents.saveAgent` and served or evaluated later.
     """
     print(f"Starting simulation with model: {model_type}")
     
     # Initialize agent based on model type
     if model_type == 'qlearning':
         # Standard Q-Learning (can have some default epsilon)
-        agent = QLearningAgent(alpha=0.2, epsilon=0.05, gamma=0.8, ticks_per_episode=steps_per_episode)
+        agent = QLearningAgent(alpha=0.2, epsilon=0.05, gamma=0.8, numTraining=episodes)
     elif model_type == 'qlearning_epsilon':
         # Q-Learning with higher exploration
-        agent = QLearningAgent(alpha=0.2, epsilon=0.3, gamma=0.8)
+        agent = QLearningAgent(alpha=0.2, epsilon=0.3, gamma=0.8, numTraining=episodes)
+    elif model_type == 'qlearning_decay':
+        # Q-Learning with a per (state, action) learning rate and
+        # exploration decaying from 0.3 towards 0.01 over the episodes
+        agent = QLearningAgent(gamma=0.8, numTraining=episodes,
+                               alphaSchedule=VisitCountSchedule(initial=1.0, power=0.8, minimum=0.05),
+                               epsilonSchedule=ExponentialDecaySchedule(0.3, 0.5, minimum=0.01, unit='episode'))
+    elif model_type == 'double_qlearning':
+        # Double Q-Learning: two tables, each bootstrapping from the other
+        agent = DoubleQLearningAgent(alpha=0.2, epsilon=0.05, gamma=0.8, numTraining=episodes)
+    elif model_type == 'dyna_q':
+        # Q-Learning over discretized states plus 10 prioritized sweeping
+        # updates from the learned model per tick
+        agent = DynaQAgent(planningSteps=10, encoder=TFStateEncoder(), alpha=0.2, epsilon=0.1, gamma=0.8,
+                           numTraining=episodes)
     elif model_type == 'approximate':
         # Approximate Q-Learning
-        # Using a much smaller alpha because features (number of cars) can be large,
-        # leading to large Q-values and potential divergence (NaNs).
-        agent = TrafficApproximateQAgent(alpha=0.001, epsilon=0.05, gamma=0.8, ticks_per_episode=steps_per_episode)
+        # Features are normalized by their running RMS and steps are scaled
+        # per feature (RMSProp), so raw car counts no longer make the
+        # weights diverge and a much larger alpha is usable.
+        agent = TrafficApproximateQAgent(alpha=0.01, epsilon=0.05, gamma=0.8, numTraining=episodes,
+                                         optimizer='rmsprop', normalize=True)
+    elif model_type == 'approximate_target':
+        # Approximate Q-Learning with target weights synced every 1000 updates
+        agent = TrafficApproximateQAgent(alpha=0.01, epsilon=0.05, gamma=0.8, numTraining=episodes,
+                                         optimizer='rmsprop', normalize=True, targetSync=1000)
+    elif model_type == 'approximate_tiles':
+        # Approximate Q-Learning over action-crossed tile coded features
+        # (see feature_specs.defaultTrafficSpec); features are binary, so
+        # no normalization is needed
+        agent = TrafficApproximateQAgent(extractor=SpecFeatureExtractor(), alpha=0.05, epsilon=0.05, gamma=0.8,
+                                         numTraining=episodes, optimizer='rmsprop')
+    elif model_type == 'approximate_sgd':
+        # Original approximate agent: plain updates on raw features need a tiny alpha
+        agent = TrafficApproximateQAgent(alpha=0.001, epsilon=0.05, gamma=0.8, numTraining=episodes)
+    elif model_type == 'value_iteration':
+        # Model-based baseline: solves the discretized MDP up front, no learning
+        agent = ValueIterationAgent(reward_type=reward_type, gamma=0.8)
+        print(f"Value iteration converged in {agent.iterations} iterations")
     else:
         print(f"Unknown model type: {model_type}")
         return
@@ -180,13 +308,18 @@ def run_simulation(model_type='qlearning', episodes=10, steps_per_episode=50, re
                 sim_state['step'] = 0
                 sim_state['state'] = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), reward_type)
                 
+                agent.stopEpisode()
+                if (convergence is not None and sim_state['episode'] <= episodes and
+                        convergence.update(agent, sim_state['total_reward']) and convergence.stopEarly):
+                    print(f"Converged after {convergence.convergedAt} episodes")
+                    sim_state['episode'] = episodes
                 sim_state['total_reward'] = 0
+                agent.startEpisode()
                 
                 if sim_state['episode'] == episodes:
                     # If last training episode, now set for testing
                     print("Starting Test Episode (No Learning, No Exploration)")
-                    agent.epsilon = 0.0
-                    agent.alpha = 0.0
+                    agent.stopTraining()
 
                 root.after(10, step_simulation)
                 return
@@ -204,12 +337,12 @@ def run_simulation(model_type='qlearning', episodes=10, steps_per_episode=50, re
                 sim_state['current_switches'] += 1
                 
             # Updates state, gets reward, and updates agent
-            prev_state = copy.deepcopy(state)
+            prev_state = state.copy()
             state.updateState(action)
             next_state = state
             reward = next_state.getReward()
             sim_state['total_reward'] += reward
-            agent.update(prev_state, action, next_state, reward)
+            agent.observeTransition(prev_state, action, next_state, reward)
             
             ui.update(state)
             sim_state['step'] += 1
@@ -217,68 +350,66 @@ def run_simulation(model_type='qlearning', episodes=10, steps_per_episode=50, re
             # Delay (100ms)
             root.after(10, step_simulation)
 
+        agent.startEpisode()
         root.after(100, step_simulation)
         root.mainloop()
-        return
+        return agent
 
     # NON GUI MODE
     # Variables to store history for plotting
     history = []
     switch_history = []
+    recorder = ReplayRecorder(replay_path) if replay_path is not None else None
 
-    for episode in range(episodes + 1):
-        if episode == episodes:
-            # Last training episode, now set for testing
-            print("Starting Test Episode (No Learning, No Exploration)")
-            agent.epsilon = 0.0
-            agent.alpha = 0.0
+    # Close the recorder even if the run fails, so the frames recorded
+    # so far are flushed and the file stays readable
+    try:
+        testing = False
+        for episode in range(episodes + 1):
+            if episode == episodes or testing:
+                # Last training episode, now set for testing
+                testing = True
+                print("Starting Test Episode (No Learning, No Exploration)")
+                agent.stopTraining()
 
-        # Initialize state
-        # Random initial cars
-        state = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), reward_type)
-        
-        total_reward = 0
-        current_data = {'ns': [], 'ew': []}
-        current_switches = 0
-        
-        for step in range(steps_per_episode):
-            # Record data
-            current_data['ns'].append(state.num_cars_waiting_ns)
-            current_data['ew'].append(state.num_cars_waiting_ew)
+            # Initialize state
+            # Random initial cars
+            state = TFState('RED', 'GREEN', random.randint(0, 5), random.randint(0, 5), reward_type)
+            if track_vehicles:
+                state.enableVehicleTracking()
 
-            # 1. Get action from agent
-            action = agent.getAction(state)
-            
-            if action == 'SWITCH':
-                current_switches += 1
-            
-            # 2. Store current state for update (deepcopy because updateState modifies in place)
-            prev_state = copy.deepcopy(state)
-            
-            # 3. Execute action (transition)
-            state.updateState(action)
-            next_state = state # state is now updated
-            
-            # 4. Calculate reward
-            reward = next_state.getReward()
-            total_reward += reward
-            
-            # 5. Update agent
-            agent.update(prev_state, action, next_state, reward)
-            
-            # Optional: Print step info
-            # print(f"Ep {episode} Step {step}: Action={action}, Reward={reward}, State={state}")
-            
-        history.append(current_data)
-        switch_history.append(current_switches)
-        
-        if episode < episodes:
+            current_data = {'ns': [], 'ew': []}
+            agent.startEpisode()
+            if recorder is not None:
+                recorder.record(state)
+
+            if macro_steps:
+                total_reward, current_switches = run_macro_episode(agent, state, steps_per_episode, current_data,
+                                                                   recorder)
+            else:
+                total_reward, current_switches = run_episode(agent, state, steps_per_episode, current_data, recorder)
+
+            agent.stopEpisode()
+            history.append(current_data)
+            switch_history.append(current_switches)
+
+            if track_vehicles:
+                waits = state.vehicles.getStats(state.tick)['all']
+                print(f"Served {waits['served']} cars, mean wait {waits['mean_wait']:.1f} ticks, "
+                      f"p90 {waits['p90_wait']:.0f} ticks")
+            if testing:
+                print(f"Test Episode finished. Total Waiting Cars: {total_reward}")
+                break
             print(f"Episode {episode + 1}/{episodes} finished. Total Waiting Cars: {total_reward}")
-        else:
-            print(f"Test Episode finished. Total Waiting Cars: {total_reward}")
-    
+            if convergence is not None and convergence.update(agent, total_reward) and convergence.stopEarly:
+                print(f"Converged after {convergence.convergedAt} episodes")
+                testing = True
+    finally:
+        if recorder is not None:
+            recorder.close()
 
     plot_results(history, switch_history)
+    return agent
 
 if __name__ == '__main__':
     # Example usage
@@ -9,6 +9,7 @@ import sys
 import inspect
 import random
 import functools
+import numpy as np
 
 
 """
@@ -236,6 +237,162 @@ class Counter(dict):
         return addend
 
 
+class Vocabulary:
+    """
+    Assigns consecutive integer indices to keys, in insertion order.
+    Several SparseVectors can share one vocabulary so the same key has
+    the same index in all of them.
+
+    >>> v = Vocabulary(['bias', 'num_cars_ns'])
+    >>> v.lookup('num_cars_ns')
+    1
+    >>> v.lookup('missing')
+    -1
+    """
+
+    def __init__(self, keys=()):
+        self.index = {}
+        self.keys = []
+        for key in keys:
+            self.add(key)
+
+    def lookup(self, key):
+        """
+        Index of key, or -1 if it has never been added.
+        """
+        return self.index.get(key, -1)
+
+    def add(self, key):
+        """
+        Index of key, adding it if needed.
+        """
+        index = self.index.get(key)
+        if index is None:
+            index = len(self.keys)
+            self.index[key] = index
+            self.keys.append(key)
+        return index
+
+    def lookupAll(self, keys, add=False):
+        """
+        Indices of several keys as an int64 array (-1 for unknown keys
+        unless add is True).
+        """
+        if add:
+            return np.fromiter((self.add(key) for key in keys), dtype=np.int64)
+        get = self.index.get
+        return np.fromiter((get(key, -1) for key in keys), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+
+class SparseVector:
+    """
+    A vector of floats indexed by arbitrary keys, stored as a NumPy array
+    over a Vocabulary.
+
+    Unlike Counter, reading a missing key returns 0.0 *without* inserting
+    it, so lookups of unseen (state, action) pairs or features do not make
+    the table grow:
+
+    >>> a = SparseVector()
+    >>> a['test']
+    0.0
+    >>> len(a)
+    0
+    >>> a['test'] += 2
+    >>> a['test']
+    2.0
+
+    Bulk operations work on index arrays from vocabulary.lookupAll and
+    run in NumPy instead of key by key:
+
+    >>> indices = a.vocabulary.lookupAll(['test', 'missing'])
+    >>> a.dot(indices, np.array([3.0, 5.0]))
+    6.0
+    """
+
+    def __init__(self, vocabulary=None, capacity=16):
+        self.vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+        self.values = np.zeros(max(int(capacity), len(self.vocabulary), 1))
+
+    def reserve(self, size):
+        """
+        Makes room for indices below size; new entries are 0.
+        """
+        if size > len(self.values):
+            values = np.zeros(max(size, 2 * len(self.values)))
+            values[:len(self.values)] = self.values
+            self.values = values
+
+    def __getitem__(self, key):
+        index = self.vocabulary.lookup(key)
+        if index < 0 or index >= len(self.values):
+            return 0.0
+        return float(self.values[index])
+
+    def __setitem__(self, key, value):
+        index = self.vocabulary.add(key)
+        self.reserve(index + 1)
+        self.values[index] = value
+
+    def __contains__(self, key):
+        return key in self.vocabulary
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __iter__(self):
+        return iter(self.vocabulary.keys)
+
+    def keys(self):
+        return list(self.vocabulary.keys)
+
+    def items(self):
+        self.reserve(len(self.vocabulary))
+        return list(zip(self.vocabulary.keys, self.values[:len(self.vocabulary)].tolist()))
+
+    def take(self, indices):
+        """
+        Values at indices; -1 (unknown key) reads as 0.
+        """
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self.values)):
+            valid = (indices >= 0) & (indices < len(self.values))
+            result = np.zeros(len(indices))
+            result[valid] = self.values[indices[valid]]
+            return result
+        return self.values[indices]
+
+    def dot(self, indices, values):
+        """
+        Dot product with the sparse vector given by (indices, values).
+        """
+        return float(np.dot(self.take(indices), values))
+
+    def axpy(self, alpha, indices, values):
+        """
+        self += alpha * (indices, values). Repeated indices accumulate.
+        """
+        if len(indices):
+            self.reserve(int(indices.max()) + 1)
+            np.add.at(self.values, indices, alpha * values)
+
+    def copy(self):
+        """
+        Returns a copy sharing the vocabulary.
+        """
+        result = SparseVector(self.vocabulary, len(self.values))
+        result.values[:] = self.values
+        return result
+
+    def toCounter(self):
+        return Counter(self.items())
+
+
 def raiseNotDefined():
     fileName = inspect.stack()[1][1]
     line = inspect.stack()[1][2]
@@ -0,0 +1,65 @@
+import random
+from agents import ValueEstimationAgent
+from mdp import TrafficMDP, ACTION_INDEX, valueIteration, policyIteration
+
+
+class ValueIterationAgent(ValueEstimationAgent):
+    """
+      A ValueIterationAgent takes the TrafficMDP model of the intersection
+      and solves it with value iteration before acting. TFStates are mapped
+      to model states through the MDP's TFStateEncoder.
+
+      It does not learn, but provides the same episode hooks as a
+      ReinforcementAgent so run_simulation can benchmark it like any
+      learning agent.
+    """
+    def __init__(self, mdp=None, encoder=None, reward_type='initial', gamma=0.8, tolerance=1e-6, maxIterations=10000):
+        ValueEstimationAgent.__init__(self, alpha=0.0, epsilon=0.0, gamma=gamma)
+        self.mdp = mdp if mdp is not None else TrafficMDP(encoder, reward_type)
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+        self.solve()
+
+    def solve(self):
+        self.values, self.qValues, self.iterations = valueIteration(
+            self.mdp, self.discount, self.tolerance, self.maxIterations)
+
+    def getQValue(self, state, action):
+        return self.qValues[ACTION_INDEX[action], self.mdp.encoder.encode(state)]
+
+    def getValue(self, state):
+        return self.values[self.mdp.encoder.encode(state)]
+
+    def getPolicy(self, state):
+        legalActions = state.getLegalActions()
+        if not legalActions:
+            return None
+        index = self.mdp.encoder.encode(state)
+        qValues = [self.qValues[ACTION_INDEX[action], index] for action in legalActions]
+        maxQValue = max(qValues)
+        return random.choice([a for a, q in zip(legalActions, qValues) if q >= maxQValue - 1e-10])
+
+    def getAction(self, state):
+        return self.getPolicy(state)
+
+    def startEpisode(self):
+        pass
+
+    def stopEpisode(self):
+        pass
+
+    def stopTraining(self):
+        pass
+
+    def observeTransition(self, state, action, nextState, deltaReward, duration=1):
+        pass
+
+
+class PolicyIterationAgent(ValueIterationAgent):
+    """
+      Same as ValueIterationAgent but solves the model with policy
+      iteration, which usually needs far fewer improvement steps.
+    """
+    def solve(self):
+        self.values, self.qValues, self.policy, self.iterations = policyIteration(
+            self.mdp, self.discount, self.tolerance, self.maxIterations)
@@ -0,0 +1,183 @@
+"""
+Per-vehicle queues and streaming wait-time histograms behind
+TFState.enableVehicleTracking. Memory does not grow with the number of
+cars served.
+"""
+
+import numpy as np
+
+
+class VehicleQueue:
+    """
+    FIFO of arrival ticks in a NumPy ring buffer. push and pop move whole
+    blocks of cars with slice assignments; the buffer doubles when full.
+    """
+    def __init__(self, capacity=1024):
+        self.ticks = np.zeros(max(1, int(capacity)), dtype=np.int64)
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def grow(self, needed):
+        capacity = max(2 * len(self.ticks), needed)
+        ticks = np.zeros(capacity, dtype=np.int64)
+        ticks[:self.size] = self.values()
+        self.ticks = ticks
+        self.head = 0
+
+    def push(self, tick, count=1):
+        """
+        Appends count cars that arrived at tick.
+        """
+        if count <= 0:
+            return
+        if self.size + count > len(self.ticks):
+            self.grow(self.size + count)
+        capacity = len(self.ticks)
+        start = (self.head + self.size) % capacity
+        end = start + count
+        if end <= capacity:
+            self.ticks[start:end] = tick
+        else:
+            self.ticks[start:] = tick
+            self.ticks[:end - capacity] = tick
+        self.size += count
+
+    def pop(self, count):
+        """
+        Removes the count oldest cars and returns their arrival ticks.
+        """
+        count = min(count, self.size)
+        capacity = len(self.ticks)
+        end = self.head + count
+        if end <= capacity:
+            popped = self.ticks[self.head:end].copy()
+        else:
+            popped = np.concatenate([self.ticks[self.head:], self.ticks[:end - capacity]])
+        self.head = end % capacity
+        self.size -= count
+        return popped
+
+    def values(self):
+        """
+        Arrival ticks of all waiting cars, oldest first.
+        """
+        end = self.head + self.size
+        if end <= len(self.ticks):
+            return self.ticks[self.head:end].copy()
+        return np.concatenate([self.ticks[self.head:], self.ticks[:end - len(self.ticks)]])
+
+
+class WaitHistogram:
+    """
+    Streaming histogram of wait times in bins of binWidth ticks; waits of
+    maxWait ticks or more share the last bin. Mean and maximum are exact,
+    percentiles are resolved to a bin.
+    """
+    def __init__(self, binWidth=1, maxWait=1000):
+        self.binWidth = int(binWidth)
+        self.counts = np.zeros(int(maxWait) // self.binWidth + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, waits):
+        if len(waits) <= 8:
+            # A tick's departures: a loop beats building bincount arrays
+            last = len(self.counts) - 1
+            for wait in waits.tolist():
+                self.counts[min(wait // self.binWidth, last)] += 1
+                self.total += wait
+                if wait > self.maximum:
+                    self.maximum = wait
+            self.count += len(waits)
+            return
+        bins = np.minimum(waits // self.binWidth, len(self.counts) - 1)
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+        self.count += len(waits)
+        self.total += int(waits.sum())
+        self.maximum = max(self.maximum, int(waits.max()))
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Upper edge of the bin holding the p-th percentile wait.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        b = int(np.searchsorted(np.cumsum(self.counts), rank, side='left'))
+        return float(min((b + 1) * self.binWidth - 1, self.maximum))
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+
+class VehicleTracker:
+    """
+    Vehicle queues and wait histograms for the directions of one
+    intersection. The caller reports the number of cars arriving and
+    departing per direction and tick, as computed by the count model.
+    """
+    def __init__(self, directions=('ns', 'ew'), capacity=1024, binWidth=1, maxWait=1000):
+        self.queues = {d: VehicleQueue(capacity) for d in directions}
+        self.histograms = {d: WaitHistogram(binWidth, maxWait) for d in directions}
+
+    def arrive(self, direction, tick, count):
+        self.queues[direction].push(tick, count)
+
+    def depart(self, direction, tick, count):
+        if count > 0:
+            self.histograms[direction].add(tick - self.queues[direction].pop(count))
+
+    def step(self, tick, ns_arrivals, ew_arrivals, ns_departures, ew_departures):
+        """
+        One tick of TFState.updateState: arrivals join before departures
+        leave, so a car can arrive and leave in the same tick (wait 0).
+        """
+        self.arrive('ns', tick, ns_arrivals)
+        self.arrive('ew', tick, ew_arrivals)
+        self.depart('ns', tick, ns_departures)
+        self.depart('ew', tick, ew_departures)
+
+    def currentWaits(self, direction, tick):
+        """
+        Waits so far of the cars still queued in direction.
+        """
+        return tick - self.queues[direction].values()
+
+    def getStats(self, tick=None):
+        """
+        Wait-time statistics of served cars per direction and overall,
+        plus the number (and, given the current tick, the longest wait so
+        far) of cars still waiting.
+        """
+        overall = None
+        stats = {}
+        for direction, histogram in self.histograms.items():
+            stats[direction] = self.summarize(histogram)
+            stats[direction]['waiting'] = len(self.queues[direction])
+            if tick is not None:
+                stats[direction]['longest_waiting'] = int(self.currentWaits(direction, tick).max(initial=0))
+            if overall is None:
+                overall = WaitHistogram(histogram.binWidth, (len(histogram.counts) - 1) * histogram.binWidth)
+            overall.merge(histogram)
+        stats['all'] = self.summarize(overall)
+        return stats
+
+    def summarize(self, histogram):
+        return {
+            'served': histogram.count,
+            'mean_wait': histogram.mean(),
+            'p50_wait': histogram.percentile(50),
+            'p90_wait': histogram.percentile(90),
+            'p99_wait': histogram.percentile(99),
+            'max_wait': histogram.maximum,
+        }